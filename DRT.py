@@ -24,6 +24,7 @@ from service import ServiceProvider
 from const import OtpMode, LegMode, DrtStatus
 from jsprit_utils import jsprit_tdm_interface
 from db_utils import db_conn
+from http_utils import router_client
 from const import CapacityDimensions as CD
 
 
@@ -37,6 +38,9 @@ class Top(Component):
     def __init__(self, *args, **kwargs):
         super(Top, self).__init__(*args, **kwargs)
 
+        router_client.configure(pool_size=self.env.config.get('service.http_pool_size'),
+                                timeout=self.env.config.get('service.http_timeout'))
+
         self.population = Population(self)
 
         self.serviceProvider = ServiceProvider(self)
@@ -49,6 +53,7 @@ class Top(Component):
     def connect_children(self):
         for person in self.population.person_list:
             self.connect(person, 'serviceProvider')
+        self.connect(self.population, 'serviceProvider')
         self.connect(self.serviceProvider, 'population')
 
     def get_result(self, result):
@@ -80,15 +85,39 @@ config = {
     'sim.create_excel': True,
     'sim.purpose': 'All pt test',
 
+    # ['DefaultBehaviour', 'ProcessBehaviour'], ProcessBehaviour runs the same states as a single process per person
     'person.behaviour': 'DefaultBehaviour',
     # 'person.mode_choice': 'DefaultModeChoice',
     'person.mode_choice': 'TimeWindowsModeChoice',
+    # ['DefaultRouting', 'DaemonRouting', 'InsertionRouting']
     'service.routing': 'DefaultRouting',
     'service.router_address': 'http://localhost:8080/otp/routers/skane/plan',
     # 'service.router_scripting_address': 'http://localhost:8080/otp/scripting/run',
     'service.osrm_route': 'http://0.0.0.0:5000/route/v1/driving/',
     'service.osrm_tdm': 'http://0.0.0.0:5000/table/v1/driving/',
     'service.modes': 'main_modes',  # ['main_modes','all_modes']
+    # maximum number of coordinates kept in the time-distance matrix cache, None for unlimited
+    'service.tdm_cache_size': 5000,
+    # number of keep-alive connections per router and timeout of a single request in seconds
+    'service.http_pool_size': 10,
+    'service.http_timeout': 120,
+    # number of OTP requests of one person sent concurrently
+    'service.otp_workers': 5,
+    # DRT requests of one person with different DRT legs, e.g. DRT_TRANSIT candidates, are solved at once
+    # on this many solvers, DaemonRouting keeps a jsprit daemon per solver
+    'service.parallel_solvers': 1,
+    # OTP responses for DRT_TRANSIT are memoized during the run, maximum number of responses, None for unlimited
+    'service.kiss_ride_cache_size': 20000,
+    # OTP responses are cached on disk between runs, None disables the cache.
+    # Cache is invalidated when OTP graph changes, graph is identified by its build time
+    # unless service.otp_graph_key is set. Changes of OTP router config are not detected, delete the file after them
+    # 'service.otp_cache_file': 'data/otp_cache.db',
+    'service.otp_cache_file': None,
+    'service.otp_cache_size': 1000000,
+    # 'service.otp_graph_key': 'skane-2018-11',
+    # OSRM routes are memoized in memory, and on disk if the file is set. Delete the file when OSRM data changes
+    'service.osrm_route_cache_size': 100000,
+    'service.osrm_route_cache_file': None,
     'date': '11-14-2018',
     'date.unix_epoch': 1542150000,  # 1542153600 - is one hour earlier!
 
@@ -108,12 +137,32 @@ config = {
     'population.input_percentage': 1.0,
     # ['all_within', 'pt_only', 'drtable_all', 'drtable_outside', 'all']
     'population.scenario': 'drtable_outside',
+    # durations and distances of direct trips are requested from OSRM table service at population load,
+    # in tiles of up to tile_size origins and destinations
+    'population.precompute_direct_trips': True,
+    'population.direct_trip_tile_size': 50,
+    'population.direct_trip_workers': 4,
+    # persons of a scenario are cached in this folder in a binary format, the cache is rebuilt when
+    # the population file, the scenario or drt.zones change. None always reads the json file
+    'population.cache_folder': 'data/population_cache',
+    # persons are created this many seconds before they plan their first trip, None creates all persons at the start.
+    # Finished persons are replaced by their trip results, so that only active persons are kept
+    # 'population.activation_lead': 600,
+    'population.activation_lead': None,
 
     # 'drt.zones': [z for z in range(12650001, 12650018)] + [z for z in range(12700001, 12700021)],  # Sjöbo + Tomelilla
     'drt.zones': [z for z in range(12650001, 12650018)],
 
     # maximum of these two will be taken as pre-booking time
     'drt.planning_in_advance': td(hours=2).total_seconds(),
+    # DRT requests are collected for this many seconds and solved in one solver call, 0 answers each request at once
+    'drt.batch_window': 0,
+    # only this many vehicles, that can be the earliest at a pickup, are sent to the solver, None sends all vehicles.
+    # Earliest arrival is estimated with cached driving times or great-circle distance at lower_bound_speed in m/s
+    'drt.candidate_vehicles': None,
+    'drt.lower_bound_speed': 35,
+    # requests that no vehicle can reach within the time window are rejected without calling the solver
+    'drt.fast_rejection': True,
     # 'drt.planning_in_advance_multiplier': 2,
 
     # # Parameters that determine maximum travel time for DRT leg
@@ -131,6 +180,9 @@ config = {
 
     'drt.PT_stops_file': 'data/zone_stops.csv',
     'drt.min_distance': 1000,
+    # local DRT trips are not routed when person.mode_choice cannot choose them over the traditional alternatives,
+    # i.e. when the direct car trip is already slower than the fastest alternative
+    'drt.prune_dominated_requests': True,
     'drt.maxPreTransitTime': 1800,  # 30 minutes
     'drt.default_max_walk': 3000,
     'drt.visualize_routes': 'false',  # should be a string
@@ -147,6 +199,10 @@ config = {
         }
     },
 
+    # main class of jsprit that solves problems from stdin, used by DaemonRouting
+    'jsprit.daemon_class': 'com.graphhopper.jsprit.examples.DRT_daemon',
+    # ['xml', 'binary'] how DaemonRouting passes problems to jsprit, binary does not write files
+    'jsprit.exchange_format': 'xml',
 }
 
 folder = '-p-{}-pre-{}-twc-{}-twm-{}-nv-{}'.format([config.get('population.scenario'),
@@ -170,6 +226,7 @@ config.update({
     'jsprit.vrp_file': '{}/vrp.xml'.format(folder),
     'jsprit.vrp_solution': '{}/problem-with-solution.xml'.format(folder),
     'jsprit.debug_folder': '{}/jsprit_debug'.format(folder),
+    'jsprit.daemon_log': '{}/jsprit_daemon.log'.format(folder),
 
     'sim.person_log_folder': '{}/person_logs'.format(folder),
     'sim.vehicle_log_folder': '{}/vehicle_logs'.format(folder),
@@ -16,6 +16,7 @@ from log_utils import TravellerEventType
 import population
 
 from sim_utils import OtpMode
+from const import EventPriority
 
 log = logging.getLogger(__name__)
 
@@ -86,17 +87,22 @@ class DefaultBehaviour(StateMachine):
 
     def on_plan(self):
         yield Event(self.env).succeed()
-        while self.env.peek() == self.env.now:
-            # TODO: this makes sure that a request-replan sequence for a person is not broken
-            # if it is, we must save multiple requests and have some policy to merge them
-            yield self.person.env.timeout(0.000001)
+        # with batching, the service provider commits DRT routes only after persons of a batch have chosen
+        batched = bool(self.person.serviceProvider.batch_window)
+        if not batched:
+            # the request is processed after other events of this time, and its choice and replanning
+            # are processed before the next request, so that a request-replan sequence is not broken
+            yield self.env.timeout(0, priority=EventPriority.REQUEST)
         self.person.update_travel_log(TravellerEventType.ACT_FINISHED, self.person.curr_activity)
 
         if self.person.planned_trip is None:
             try:
                 self.person.update_travel_log(TravellerEventType.TRIP_REQUEST_SUBMITTED, self.person.curr_activity)
 
-                alternatives = self.person.serviceProvider.request(self.person)
+                if batched:
+                    alternatives = yield from self.person.serviceProvider.batched_request(self.person)
+                else:
+                    alternatives = self.person.serviceProvider.request(self.person)
 
                 self.person.alternatives = alternatives
                 self.person.update_travel_log(TravellerEventType.TRIP_ALTERNATIVES_RECEIVED, self.person.curr_activity)
@@ -171,6 +177,7 @@ class DefaultBehaviour(StateMachine):
     def on_finalize(self):
         yield Event(self.env).succeed()
         # self.person.log.close()
+        self.person.release()
 
     def on_unplannable(self):
         yield Event(self.env).succeed()
@@ -179,6 +186,7 @@ class DefaultBehaviour(StateMachine):
                             self.person.next_activity.coord))
         self.person.serviceProvider.log_unplannable(self.person)
         self.person.update_travel_log(TravellerEventType.NO_RUTE)
+        self.person.release()
 
     def on_unchoosable(self):
         yield Event(self.env).succeed()
@@ -187,6 +195,7 @@ class DefaultBehaviour(StateMachine):
                             self.person.next_activity.coord))
         self.person.serviceProvider.log_unchoosable(self.person)
         self.person.update_travel_log(TravellerEventType.NO_RUTE)
+        self.person.release()
 
     def on_unactivatable(self):
         yield Event(self.env).succeed()
@@ -195,6 +204,7 @@ class DefaultBehaviour(StateMachine):
                             self.person.next_activity.coord))
         self.person.serviceProvider.log_unactivatable(self.person)
         self.person.update_travel_log(TravellerEventType.NO_RUTE)
+        self.person.release()
 
     def on_unreactivatable(self):
         yield Event(self.env).succeed()
@@ -203,9 +213,169 @@ class DefaultBehaviour(StateMachine):
                             self.person.next_activity.coord))
         self.person.serviceProvider.log_unactivatable(self.person)
         self.person.update_travel_log(TravellerEventType.NO_RUTE)
+        self.person.release()
 
     def on_trip_exception(self):
         raise NotImplementedError()
 
     def on_activity_exception(self):
         raise NotImplementedError()
+
+
+class ProcessBehaviour(object):
+    """Person's behaviour with the states and transitions of DefaultBehaviour, executed as a single simpy process.
+
+    A transition only changes the state field and calls the next step of the process,
+    no new process and no extra zero-time event is created per transition.
+    Select it with person.behaviour: 'ProcessBehaviour'.
+    """
+
+    INITIAL = 'initial'
+    ACTIVITY = 'activity'
+    PLANING = 'planing'
+    CHOOSING = 'choosing'
+    TRIP = 'trip'
+    FINAL = 'final'
+
+    def __init__(self, person):
+        self.person = person
+        self.env = self.person.env
+        self.state = self.INITIAL
+
+    def activate(self):
+        """The process of a person. Runs activities and trips until the person reaches the final state"""
+        self.state = self.ACTIVITY
+        planned = yield from self._activity(reactivated=False)
+        while planned:
+            self.state = self.PLANING
+            trip = yield from self._plan()
+            if trip is None:
+                return
+            self.state = self.CHOOSING
+            if not self._choose():
+                return
+            self.state = self.TRIP
+            if not (yield from self._execute_trip()):
+                return
+            self.state = self.ACTIVITY
+            planned = yield from self._activity(reactivated=True)
+
+    def _activity_time_screwed(self):
+        if self.person.next_activity.start_time < self.env.now:
+            log.error('Person {} should have already started a new activity at {}. It will be removed.'
+                      .format(self.person.id, self.person.next_activity.start_time))
+            return True
+        else:
+            return False
+
+    def _activity(self, reactivated):
+        """Waits until the person plans a trip to the next activity. Returns False if the person cannot travel"""
+        if reactivated:
+            self.person.update_otp_params()
+        if self._activity_time_screwed():
+            self._unactivatable()
+            return False
+        if not reactivated:
+            self.person.update_otp_params()
+
+        try:
+            direct_trip = self.person.serviceProvider.standalone_osrm_request(self.person)
+            timeout = self.person.get_planning_time(direct_trip)
+            self.person.set_direct_trip(direct_trip)
+        except (OTPNoPath, OTPTrivialPath) as e:
+            if reactivated and isinstance(e, OTPTrivialPath):
+                raise
+            if reactivated:
+                log.warning('{}\n{}'.format(e.msg, e.context))
+            else:
+                log.warning('{}: {}\n{}'.format(self.env.now, e.msg, e.context))
+            log.warning('{}: Person {} will be excluded from the simulation'.format(self.env.now, self.person))
+            self._unactivatable()
+            return False
+
+        if timeout > 0:
+            self.person.update_travel_log(TravellerEventType.ACT_STARTED, self.person.curr_activity)
+        yield self.env.timeout(timeout)
+        return True
+
+    def _plan(self):
+        """Requests trip alternatives. Returns the alternatives or None if the person is excluded"""
+        # with batching, the service provider commits DRT routes only after persons of a batch have chosen
+        batched = bool(self.person.serviceProvider.batch_window)
+        if not batched:
+            # see DefaultBehaviour.on_plan
+            yield self.env.timeout(0, priority=EventPriority.REQUEST)
+        self.person.update_travel_log(TravellerEventType.ACT_FINISHED, self.person.curr_activity)
+
+        if self.person.planned_trip is not None:
+            return None
+        try:
+            self.person.update_travel_log(TravellerEventType.TRIP_REQUEST_SUBMITTED, self.person.curr_activity)
+
+            if batched:
+                alternatives = yield from self.person.serviceProvider.batched_request(self.person)
+            else:
+                alternatives = self.person.serviceProvider.request(self.person)
+
+            self.person.alternatives = alternatives
+            self.person.update_travel_log(TravellerEventType.TRIP_ALTERNATIVES_RECEIVED, self.person.curr_activity)
+            return alternatives
+        except (OTPTrivialPath, OTPUnreachable) as e:
+            log.warning('{}'.format(e.msg))
+            log.warning('{}: Excluding person from simulation. {}'.format(self.env.now, self.person))
+            self._exclude(self.person.serviceProvider.log_unplannable)
+            return None
+
+    def _choose(self):
+        """Chooses one of the alternatives according to config.person.mode_choice and starts the trip.
+        Returns False if no trip can be chosen"""
+        chosen_trip = self.person.mode_choice.choose(self.person.alternatives)
+        if chosen_trip is None:
+            log.warning('{}: Trip could not be selected for Person {}.'
+                        'It is possibly because there is no PT and person has no driving license.\n'
+                        'Person will be excluded from simulation.'
+                        .format(self.env.now, self.person.id))
+            log.debug('{}\n{}'.format(self.person, self.person.alternatives))
+            self._exclude(self.person.serviceProvider.log_unchoosable)
+            return False
+
+        log.info('{}: Person {} have chosen trip {}'.format(self.env.now, self.person.id, chosen_trip))
+        self.person.planned_trip = chosen_trip.deepcopy()
+        self.person.init_actual_trip()
+        self.person.serviceProvider.start_trip(self.person)
+        self.person.update_travel_log(TravellerEventType.TRIP_CHOSEN, chosen_trip.deepcopy())
+        return True
+
+    def _execute_trip(self):
+        """Waits until the person is delivered. Returns False if it was the last trip"""
+        self.env.process(self.person.serviceProvider.execute_trip(self.person))
+        self.person.update_travel_log(TravellerEventType.TRIP_STARTED)
+        yield self.person.delivered
+        self.person.update_travel_log(TravellerEventType.TRIP_FINISHED)
+        log.info('{}: Person {} has finished trip {}'.format(self.env.now, self.person.id, self.person.actual_trip))
+        self.person.reset_delivery()
+        self.person.log_executed_trip()
+        if self.person.change_activity() == -1:
+            self.state = self.FINAL
+            self.person.release()
+            return False
+        return True
+
+    def _unactivatable(self):
+        log.warning('{}: {} going from {} to {} cannot reach the destination. Ignoring the person.'
+                    .format(self.env.now, self.person, self.person.curr_activity.coord,
+                            self.person.next_activity.coord))
+        self.person.serviceProvider.log_unactivatable(self.person)
+        self.person.update_travel_log(TravellerEventType.NO_RUTE)
+        self.state = self.FINAL
+        self.person.release()
+
+    def _exclude(self, service_log):
+        """Moves a person that received no alternatives to the final state"""
+        log.warning('{}: {} going from {} to {} received none alternatives. Ignoring the person.'
+                    .format(self.env.now, self.person, self.person.curr_activity.coord,
+                            self.person.next_activity.coord))
+        service_log(self.person)
+        self.person.update_travel_log(TravellerEventType.NO_RUTE)
+        self.state = self.FINAL
+        self.person.release()
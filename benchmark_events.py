@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Counts simulation events needed to order trip requests and vehicle act completions of the same time.
+
+Persons plan and vehicles complete acts on a coarse time grid, so many of them coincide.
+The busy-wait model orders them the way behaviour and vehicle did before event priorities:
+a request waits in steps of 1e-6 s until no other event is due and a vehicle that completes an act
+while other events are due waits 0.05 s. The priority model schedules requests and act completions
+with EventPriority.
+
+Usage: python benchmark_events.py [number of persons] [number of vehicles]
+"""
+
+import sys
+
+import simpy
+
+from desmod.simulation import SimEnvironment
+from const import EventPriority
+
+
+class CountingEnvironment(SimEnvironment):
+    def __init__(self, config):
+        super(CountingEnvironment, self).__init__(config)
+        self.processed_events = 0
+
+    def step(self):
+        self.processed_events += 1
+        super(CountingEnvironment, self).step()
+
+
+class Model(object):
+
+    def __init__(self, env, n_persons, n_vehicles, busy_wait):
+        self.env = env
+        self.busy_wait = busy_wait
+        self.requests = 0
+        # shift of requests and act completions from their planned times
+        self.delay = 0
+        self.vehicles = [{'rerouted': env.event()} for _ in range(n_vehicles)]
+        for i in range(n_persons):
+            env.process(self.person(i, env.rand.randrange(0, 3600, 60)))
+        for vehicle in self.vehicles:
+            env.process(self.vehicle(vehicle))
+
+    def person(self, i, planning_time):
+        yield self.env.timeout(planning_time)
+        if self.busy_wait:
+            while self.env.peek() == self.env.now:
+                yield self.env.timeout(0.000001)
+        else:
+            yield self.env.timeout(0, priority=EventPriority.REQUEST)
+        self.delay += self.env.now - planning_time
+        self.requests += 1
+        vehicle = self.vehicles[i % len(self.vehicles)]
+        vehicle['rerouted'].succeed()
+        vehicle['rerouted'] = self.env.event()
+
+    def vehicle(self, vehicle):
+        while True:
+            end_time = self.env.now + self.env.rand.randrange(60, 600, 60)
+            if self.busy_wait:
+                act_executed = self.env.timeout(end_time - self.env.now)
+            else:
+                act_executed = self.env.timeout(end_time - self.env.now, priority=EventPriority.ACT_COMPLETION)
+            rerouted = vehicle['rerouted']
+            yield rerouted | act_executed
+            if rerouted.triggered:
+                continue
+            if self.busy_wait and self.env.peek() == self.env.now:
+                yield self.env.timeout(0.05)
+            self.delay += self.env.now - end_time
+
+
+def run(n_persons, n_vehicles, busy_wait):
+    env = CountingEnvironment({'sim.seed': 42, 'db.file': ':memory:'})
+    model = Model(env, n_persons, n_vehicles, busy_wait)
+    env.run(until=3600)
+    return env.processed_events, model.requests, model.delay
+
+
+if __name__ == '__main__':
+    n_persons = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_vehicles = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    print('{} persons and {} vehicles during an hour, simpy {}'.format(n_persons, n_vehicles, simpy.__version__))
+
+    results = {}
+    for name, busy_wait in (('busy-wait', True), ('priority', False)):
+        events, requests, delay = run(n_persons, n_vehicles, busy_wait)
+        results[name] = events
+        print('{:>10}: {:8d} events, {} requests, {:.3f} s total shift of requests and acts'
+              .format(name, events, requests, delay))
+    print('event priorities process {:.0%} of the busy-wait events'.format(results['priority'] / results['busy-wait']))
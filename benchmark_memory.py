@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compares memory taken by routes built from the slotted Coord, Step, Leg and DrtAct of sim_utils
+with the same routes built from plain classes that keep attributes in __dict__.
+
+Usage: python benchmark_memory.py [number of legs] [steps per leg]
+"""
+
+import sys
+import gc
+import tracemalloc
+
+from sim_utils import Coord, Step, Leg, DrtAct
+
+
+class DictCoord(object):
+    def __init__(self, lat, lon):
+        self.lat = lat
+        self.lon = lon
+
+
+class DictStep(object):
+    def __init__(self, start_coord, end_coord, distance, duration):
+        self.start_coord = start_coord
+        self.end_coord = end_coord
+        self.distance = distance
+        self.duration = duration
+
+
+class DictLeg(object):
+    def __init__(self, mode=None, start_coord=None, end_coord=None, distance=None, duration=None, steps=None):
+        self.mode = mode
+        self.start_coord = start_coord
+        self.end_coord = end_coord
+        self.distance = distance
+        self.duration = duration
+        self.steps = steps
+        self.from_stop = None
+        self.to_stop = None
+        self.start_time = None
+        self.end_time = None
+
+
+class DictDrtAct(object):
+    def __init__(self, type_=None, start_coord=None, end_coord=None, distance=None, duration=None, steps=None):
+        self.type = type_
+        self.person = None
+        self.start_coord = start_coord
+        self.end_coord = end_coord
+        self.distance = distance
+        self.duration = duration
+        self.start_time = None
+        self.end_time = None
+        self._steps = steps
+        self._step_end_times = None
+
+
+def build(coord_cls, step_cls, leg_cls, act_cls, n_legs, n_steps):
+    """Builds n_legs legs and as many DRT acts, each with n_steps steps, the way OSRM responses are parsed:
+    every step has its own start and end coordinates"""
+    objects = []
+    for i in range(n_legs):
+        steps = []
+        for j in range(n_steps):
+            start = coord_cls(55.0 + i * 1e-4 + j * 1e-6, 13.0 + j * 1e-6)
+            end = coord_cls(55.0 + i * 1e-4 + (j + 1) * 1e-6, 13.0 + (j + 1) * 1e-6)
+            steps.append(step_cls(start, end, 10.0, 1.0))
+        objects.append(leg_cls(mode='CAR', start_coord=steps[0].start_coord, end_coord=steps[-1].end_coord,
+                               distance=10.0 * n_steps, duration=1.0 * n_steps, steps=steps))
+        objects.append(act_cls(type_=DrtAct.DRIVE, start_coord=steps[0].start_coord, end_coord=steps[-1].end_coord,
+                               distance=10.0 * n_steps, duration=1.0 * n_steps, steps=list(steps)))
+    return objects
+
+
+def measure(name, coord_cls, step_cls, leg_cls, act_cls, n_legs, n_steps):
+    gc.collect()
+    tracemalloc.start()
+    objects = build(coord_cls, step_cls, leg_cls, act_cls, n_legs, n_steps)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    print('{:>8}: {:8.1f} MB, {:6.1f} bytes per step'.format(name, current / 2**20, current / (n_legs * n_steps)))
+    return current
+
+
+def slotted_leg(mode=None, start_coord=None, end_coord=None, distance=None, duration=None, steps=None):
+    return Leg(mode=mode, start_coord=start_coord, end_coord=end_coord, distance=distance, duration=duration,
+               steps=steps)
+
+
+def slotted_act(type_=None, start_coord=None, end_coord=None, distance=None, duration=None, steps=None):
+    return DrtAct(type_=type_, start_coord=start_coord, end_coord=end_coord, distance=distance, duration=duration,
+                  steps=steps)
+
+
+if __name__ == '__main__':
+    n_legs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_steps = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print('{} legs and {} DRT acts with {} steps each'.format(n_legs, n_legs, n_steps))
+
+    dict_memory = measure('__dict__', DictCoord, DictStep, DictLeg, DictDrtAct, n_legs, n_steps)
+    slots_memory = measure('__slots__', Coord, Step, slotted_leg, slotted_act, n_legs, n_steps)
+    print('slotted objects take {:.0%} of the memory'.format(slots_memory / dict_memory))
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Caches for routing results that are reused between requests
+
+@author: ai6644
+"""
+
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class TimeDistanceMatrixCache(object):
+    """Stores time and distance between coordinates fetched from OSRM table service.
+
+    Rows are kept per origin coordinate, so that a new request only has to fetch rows and columns
+    of coordinates it has not seen yet.
+    Coordinates are kept in the order of their last use. When the cache holds more than max_size coordinates,
+    the least recently used coordinates that are not referenced by a current request are evicted.
+
+    Parameters
+    ----------
+    max_size : <int> maximum number of coordinates to keep, None for unlimited
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        # origin -> {destination: (duration, distance)}
+        self._rows = OrderedDict()
+        self.fetched_pairs = 0
+        self.reused_pairs = 0
+        self.evicted_coords = 0
+
+    def __contains__(self, coord):
+        return coord in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, origin, destination):
+        """Returns (duration, distance) between two coordinates or None if the pair is not cached"""
+        row = self._rows.get(origin)
+        if row is None:
+            return None
+        return row.get(destination)
+
+    def split_missing(self, coords):
+        """Splits coordinates into the ones missing from the cache and the cached ones,
+        which have no pairs to some of the other cached coordinates from coords.
+
+        :return: (new coordinates, incomplete cached coordinates)
+        """
+        new_coords = [coord for coord in coords if coord not in self._rows]
+        cached_coords = [coord for coord in coords if coord in self._rows]
+        incomplete_coords = []
+        for origin in cached_coords:
+            row = self._rows.get(origin)
+            if any(destination not in row for destination in cached_coords):
+                incomplete_coords.append(origin)
+        return new_coords, incomplete_coords
+
+    def add(self, origins, destinations, durations, distances):
+        """Saves a (sub)matrix from OSRM, rows correspond to origins and columns to destinations"""
+        for origin, duration_row, distance_row in zip(origins, durations, distances):
+            row = self._rows.setdefault(origin, {})
+            for destination, duration, distance in zip(destinations, duration_row, distance_row):
+                row[destination] = (duration, distance)
+                # the matrix is not symmetric, so a destination needs its own row to be treated as cached
+                self._rows.setdefault(destination, {})
+        self.fetched_pairs += len(origins) * len(destinations)
+
+    def touch(self, coords):
+        """Marks coordinates as recently used"""
+        for coord in coords:
+            if coord in self._rows:
+                self._rows.move_to_end(coord)
+
+    def is_full(self):
+        """Returns True if the cache holds more than max_size coordinates"""
+        return self.max_size is not None and len(self._rows) > self.max_size
+
+    def evict(self, referenced_coords):
+        """Removes least recently used coordinates that are not in referenced_coords
+        until the cache fits into max_size"""
+        if not self.is_full():
+            return
+
+        referenced_coords = set(referenced_coords)
+        to_evict = set()
+        excess = len(self._rows) - self.max_size
+        for coord in self._rows.keys():
+            if len(to_evict) >= excess:
+                break
+            if coord not in referenced_coords:
+                to_evict.add(coord)
+
+        for coord in to_evict:
+            del self._rows[coord]
+        for row in self._rows.values():
+            for coord in to_evict:
+                row.pop(coord, None)
+        self.evicted_coords += len(to_evict)
+        log.debug('Evicted {} coordinates from time-distance matrix cache'.format(len(to_evict)))
+
+
+class OtpCache(object):
+    """Stores parsed OTP responses in a sqlite file, so that they are shared between simulation runs.
+
+    Entries are keyed by the full set of request parameters and by the graph key of the OTP router.
+    Entries of other graphs are removed when the cache is opened.
+    When the cache holds more than max_size entries, the least recently used are removed.
+
+    The cache may be used from several threads.
+
+    Parameters
+    ----------
+    db_file : <str> path to the sqlite file
+    graph_key : <str> identifies the OTP graph the responses were calculated on
+    max_size : <int> maximum number of entries, None for unlimited
+    """
+
+    # trips are pickled, the table is renamed when the layout of the pickled classes changes
+    TABLE = 'otp_cache_v2'
+    COMMIT_EVERY = 100
+
+    def __init__(self, db_file, graph_key, max_size=None):
+        self.graph_key = str(graph_key)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS {}
+                             (
+                                 key TEXT PRIMARY KEY,
+                                 graph TEXT,
+                                 value BLOB,
+                                 last_used FLOAT
+                             );'''.format(self.TABLE))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS {0}_last_used ON {0} (last_used)'.format(self.TABLE))
+        removed = self.conn.execute('DELETE FROM {} WHERE graph != (?)'.format(self.TABLE), (self.graph_key,)).rowcount
+        if removed > 0:
+            log.info('Removed {} OTP cache entries of another graph'.format(removed))
+        self._evict()
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(params, *extra):
+        """Normalizes request parameters to a string key"""
+        return json.dumps([sorted((str(k), str(v)) for k, v in params.items())] + [str(e) for e in extra])
+
+    def get(self, key):
+        """Returns a cached value or None"""
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM {} WHERE key=(?)'.format(self.TABLE), (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute('UPDATE {} SET last_used=(?) WHERE key=(?)'.format(self.TABLE), (time.time(), key))
+            self._count_write()
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO {} (key, graph, value, last_used) VALUES (?,?,?,?)'
+                              .format(self.TABLE),
+                              (key, self.graph_key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+                               time.time()))
+            self._count_write()
+
+    def _count_write(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_EVERY:
+            self._evict()
+            self.conn.commit()
+            self._uncommitted = 0
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        size = self.conn.execute('SELECT COUNT(*) FROM {}'.format(self.TABLE)).fetchone()[0]
+        if size > self.max_size:
+            self.conn.execute('DELETE FROM {0} WHERE key IN (SELECT key FROM {0} ORDER BY last_used LIMIT (?))'
+                              .format(self.TABLE), (size - self.max_size,))
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self.conn.commit()
+            self.conn.close()
+
+
+class OsrmRouteCache(object):
+    """Memoizes OSRM routes between pairs of coordinates.
+
+    Steps of a route are kept as a tuple and shared between all trips built from the cache,
+    so they must not be modified. Routes are kept in memory and optionally in a sqlite file to be shared
+    between simulation runs. The file must be deleted when OSRM data changes.
+
+    Parameters
+    ----------
+    max_size : <int> maximum number of routes kept in memory, None for unlimited
+    db_file : <str> path to the sqlite file, None to keep routes only in memory
+    """
+
+    # steps are pickled, the table is renamed when the layout of Step or Coord changes
+    TABLE = 'osrm_route_cache_v2'
+    COMMIT_EVERY = 100
+
+    def __init__(self, max_size=None, db_file=None):
+        self.max_size = max_size
+        self._routes = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+
+        self.conn = None
+        if db_file is not None:
+            self.conn = sqlite3.connect(db_file, check_same_thread=False)
+            self.conn.execute('PRAGMA synchronous=OFF')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS {}
+                                 (
+                                     key TEXT PRIMARY KEY,
+                                     value BLOB
+                                 );'''.format(self.TABLE))
+            self.conn.commit()
+
+    @staticmethod
+    def _disk_key(origin, destination):
+        return '{},{};{},{}'.format(origin.lat, origin.lon, destination.lat, destination.lon)
+
+    def get(self, origin, destination):
+        """Returns a tuple of steps or None if the route is not cached"""
+        key = (origin, destination)
+        with self._lock:
+            steps = self._routes.get(key)
+            if steps is not None:
+                self._routes.move_to_end(key)
+                self.hits += 1
+                return steps
+
+            if self.conn is not None:
+                row = self.conn.execute('SELECT value FROM {} WHERE key=(?)'.format(self.TABLE),
+                                        (self._disk_key(origin, destination),)).fetchone()
+                if row is not None:
+                    steps = pickle.loads(row[0])
+                    self._remember(key, steps)
+                    self.disk_hits += 1
+                    return steps
+
+            self.misses += 1
+            return None
+
+    def put(self, origin, destination, steps):
+        steps = tuple(steps)
+        with self._lock:
+            self._remember((origin, destination), steps)
+            if self.conn is not None:
+                self.conn.execute('INSERT OR REPLACE INTO {} (key, value) VALUES (?,?)'.format(self.TABLE),
+                                  (self._disk_key(origin, destination),
+                                   pickle.dumps(steps, protocol=pickle.HIGHEST_PROTOCOL)))
+                self._uncommitted += 1
+                if self._uncommitted >= self.COMMIT_EVERY:
+                    self.conn.commit()
+                    self._uncommitted = 0
+        return steps
+
+    def _remember(self, key, steps):
+        self._routes[key] = steps
+        if self.max_size is not None and len(self._routes) > self.max_size:
+            self._routes.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            if self.conn is not None:
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
+
+
+class KissRideCache(object):
+    """Memoizes responses of OTP to kiss and ride requests of DRT_TRANSIT trips during one simulation run.
+
+    Persons with the same origin, destination and activity times send identical requests,
+    and every maxPreTransitTime reduction cycle of a person sends a request that other persons may repeat.
+    DRT_TRANSIT trips are built by modifying received trips, so copies are returned.
+    Routing errors are memoized as well.
+
+    The cache may be used from several threads.
+
+    Parameters
+    ----------
+    max_size : <int> maximum number of responses, None for unlimited
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns copies of cached trips or None if the response is not cached.
+        Raises the cached routing error"""
+        with self._lock:
+            response = self._responses.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self._responses.move_to_end(key)
+            self.hits += 1
+
+        trips, error = response
+        if error is not None:
+            raise error[0](error[1], error[2])
+        return [trip.deepcopy() for trip in trips]
+
+    def put(self, key, trips):
+        """Saves trips, returns their copies"""
+        self._remember(key, (trips, None))
+        return [trip.deepcopy() for trip in trips]
+
+    def put_error(self, key, error):
+        """Saves OTPError"""
+        self._remember(key, (None, (error.__class__, error.msg, error.context)))
+
+    def _remember(self, key, response):
+        with self._lock:
+            self._responses[key] = response
+            if self.max_size is not None and len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
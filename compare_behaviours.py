@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Checks that ProcessBehaviour gives the same results as DefaultBehaviour.
+
+A synthetic population with three activities per person is simulated with both behaviours against a service
+provider that answers requests without OTP, OSRM and jsprit. Answers depend on the number of persons
+currently travelling, so any change in the order of requests, trip starts and deliveries changes the results.
+Some persons get no alternatives and are excluded. The ordered service calls and the person logs
+of both runs are compared, with persons created at the start and with population.activation_lead.
+
+Usage: python compare_behaviours.py [number of persons]
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+from desmod.component import Component
+from desmod.simulation import simulate
+
+import mode_choice
+from const import OtpMode
+from population import Population
+from sim_utils import DirectTrip, Trip, haversine_distance
+
+BEHAVIOURS = ['DefaultBehaviour', 'ProcessBehaviour']
+
+
+class RandomModeChoice(object):
+    """Chooses any of the alternatives with the simulation random generator"""
+
+    def __init__(self, person):
+        self.person = person
+        self.env = person.env
+
+    def choose(self, alternatives):
+        if len(alternatives) == 0:
+            return None
+        return alternatives[self.env.rand.randrange(len(alternatives))]
+
+
+mode_choice.RandomModeChoice = RandomModeChoice
+
+
+class SyntheticPopulation(Population):
+    """Estimates direct trips from great-circle distance instead of OSRM"""
+
+    def _precompute_direct_trips(self):
+        for activities in self._activity_chains():
+            for origin, destination in zip(activities[:-1], activities[1:]):
+                distance = haversine_distance(origin.coord, destination.coord)
+                self._direct_trip_estimates[(origin.coord, destination.coord)] = (int(distance / 10) + 60, distance)
+
+
+class RecordingServiceProvider(Component):
+    """Logs every call of a person. Trips take longer when more persons are travelling"""
+
+    base_name = 'serviceProvider'
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingServiceProvider, self).__init__(*args, **kwargs)
+        self.batch_window = 0
+        self.population = None
+        self.add_connections('population')
+        self.calls = []
+        self.travelling = 0
+
+    def standalone_osrm_request(self, person):
+        duration, distance = self.population.get_direct_trip_estimate(person.curr_activity.coord,
+                                                                      person.next_activity.coord)
+        return DirectTrip(duration=duration, distance=distance, route_loader=None)
+
+    def request(self, person):
+        self.calls.append(('request', self.env.now, person.id, self.travelling))
+        if person.id % 17 == 0:
+            return []
+        alternatives = []
+        for mode in [OtpMode.CAR, OtpMode.WALK]:
+            trip = Trip()
+            trip.set_empty_trip(mode, person.curr_activity.coord, person.next_activity.coord)
+            trip.set_duration(60 * (1 + self.travelling % 5))
+            alternatives.append(trip)
+        return alternatives
+
+    def start_trip(self, person):
+        self.travelling += 1
+        self.calls.append(('start', self.env.now, person.id, self.travelling))
+
+    def execute_trip(self, person):
+        yield self.env.timeout(person.planned_trip.duration)
+        self.travelling -= 1
+        self.calls.append(('delivered', self.env.now, person.id, self.travelling))
+        person.delivered.succeed()
+
+    def log_unplannable(self, person):
+        self.calls.append(('unplannable', self.env.now, person.id))
+
+    def log_unchoosable(self, person):
+        self.calls.append(('unchoosable', self.env.now, person.id))
+
+    def log_unactivatable(self, person):
+        self.calls.append(('unactivatable', self.env.now, person.id))
+
+
+class Top(Component):
+    base_name = ''
+
+    def __init__(self, *args, **kwargs):
+        super(Top, self).__init__(*args, **kwargs)
+        self.population = SyntheticPopulation(self)
+        self.serviceProvider = RecordingServiceProvider(self)
+
+    def connect_children(self):
+        for person in self.population.person_list:
+            self.connect(person, 'serviceProvider')
+        self.connect(self.population, 'serviceProvider')
+        self.connect(self.serviceProvider, 'population')
+
+    def get_result(self, result):
+        super(Top, self).get_result(result)
+        result['calls'] = self.serviceProvider.calls
+
+
+def write_population(file_name, n_persons):
+    rand = random.Random(5)
+
+    def activity(type_, zones, start_time=None, end_time=None):
+        return {'type': type_, 'start_time': start_time, 'end_time': end_time,
+                'coord': {'lat': str(55 + rand.randint(0, 5) / 10), 'lon': str(13 + rand.randint(0, 5) / 10)},
+                'zone': str(rand.choice(zones))}
+
+    persons = []
+    for _ in range(n_persons):
+        hour = rand.randint(1, 15)
+        persons.append({'activities': [
+            activity('HOME', [1, 2, 3], end_time='{:02d}:00:00'.format(hour)),
+            activity('WORK', [1, 2], start_time='{:02d}:30:00'.format(hour + 2),
+                     end_time='{:02d}:00:00'.format(hour + 5)),
+            activity('HOME', [1, 2, 3], start_time='{:02d}:{:02d}:00'.format(hour + 6, rand.choice([0, 30])))]})
+    with open(file_name, 'w') as f:
+        json.dump({'population_in_pt': persons}, f)
+
+
+def run(behaviour, population_file, log_folder, activation_lead):
+    config = {
+        'sim.duration': '86400 s',
+        'sim.duration_sec': 86400,
+        'sim.seed': 1,
+        'sim.person_log_folder': log_folder,
+        'population.input_file': population_file,
+        'population.scenario': 'drtable_outside',
+        'population.input_percentage': 1.0,
+        'population.cache_folder': None,
+        'population.precompute_direct_trips': True,
+        'population.activation_lead': activation_lead,
+        'drt.zones': [1, 2],
+        'drt.planning_in_advance': 7200,
+        'person.behaviour': behaviour,
+        'person.mode_choice': 'RandomModeChoice',
+    }
+    for travel_type, multiplier in [('in', 1.5), ('out', 1.9), ('within', 1.7)]:
+        config['pt.time_window_multiplier_' + travel_type] = multiplier
+        config['pt.time_window_constant_' + travel_type] = 0
+    for attribute in ['dimensions', 'driving_license', 'walking_speed', 'age', 'boarding_time', 'leaving_time']:
+        config['person.default_attr.' + attribute] = 1
+
+    start = time.time()
+    result = simulate(config, Top)
+    duration = time.time() - start
+    person_logs = {}
+    for file_name in sorted(os.listdir(log_folder)):
+        with open(os.path.join(log_folder, file_name)) as f:
+            person_logs[file_name] = f.read()
+    return result['calls'], person_logs, duration
+
+
+def main():
+    n_persons = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    logging.disable(logging.WARNING)
+    identical = True
+    with tempfile.TemporaryDirectory() as folder:
+        population_file = os.path.join(folder, 'population.json')
+        write_population(population_file, n_persons)
+        for activation_lead in [None, 600]:
+            runs = []
+            for behaviour in BEHAVIOURS:
+                log_folder = tempfile.mkdtemp(dir=folder)
+                calls, person_logs, duration = run(behaviour, population_file, log_folder, activation_lead)
+                print('activation_lead {}, {}: {} service calls, {} person logs, {:.2f} s'
+                      .format(activation_lead, behaviour, len(calls), len(person_logs), duration))
+                runs.append((calls, person_logs))
+
+            (default_calls, default_logs), (process_calls, process_logs) = runs
+            for default_call, process_call in zip(default_calls, process_calls):
+                if default_call != process_call:
+                    print('First differing call: {} and {}'.format(default_call, process_call))
+                    break
+            calls_identical = default_calls == process_calls
+            logs_identical = default_logs == process_logs
+            print('Service calls {}, person logs {}'.format('identical' if calls_identical else 'differ',
+                                                            'identical' if logs_identical else 'differ'))
+            identical = identical and calls_identical and logs_identical
+    return 0 if identical else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
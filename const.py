@@ -105,6 +105,17 @@ class OtpMode(object):
             raise Exception('unsupported mode {}'.format(string))
 
 
+class EventPriority(object):
+    """Order of events scheduled at the same time by desmod.simulation.SimEnvironment.timeout, lower first.
+    simpy processes urgent events with 0 and normal events with 1.
+
+    A trip request is processed after the normal events of its time and a vehicle completes an act
+    after the requests, so that a request can reroute a vehicle that reaches a stop at the same time.
+    """
+    REQUEST = 2
+    ACT_COMPLETION = 3
+
+
 class TravelType(Enum):
     WITHIN = 'within'
     IN = 'in'
@@ -165,3 +176,4 @@ class DrtStatus(Enum):
     too_short_drt_leg = 'too_short_local'
     too_late_request = 'too_late_request'
     too_long_pt_trip = 'too_long_pt_trip'  # when the whole DRT_TRANSIT trip is more than max time window (direct*1.5)
+    dominated = 'dominated'  # DRT cannot be faster than an already received traditional alternative
@@ -92,6 +92,11 @@ class SimEnvironment(simpy.Environment):
         sim_time = ((self.now if t is None else t) * ts_mag, ts_unit)
         return scale_time(sim_time, target_scale)
 
+    def timeout(self, delay=0, value=None, priority=simpy.events.NORMAL):
+        """Return a new :class:`PriorityTimeout` event with a `delay`, `value`
+        and `priority` among events of the same time."""
+        return PriorityTimeout(self, delay, value, priority)
+
     def get_progress(self):
         if isinstance(self.until, SimStopEvent):
             t_stop = self.until.t_stop
@@ -100,6 +105,27 @@ class SimEnvironment(simpy.Environment):
         return self.sim_index, self.now, t_stop, self.timescale
 
 
+class PriorityTimeout(simpy.events.Timeout):
+    """Timeout that is scheduled with a given priority.
+
+    Events of the same time are processed in the order of their priorities,
+    lower values first. :data:`simpy.events.URGENT` is 0 and
+    :data:`simpy.events.NORMAL` is 1, larger values are processed after all
+    normal events of the same time.
+
+    """
+    def __init__(self, env, delay, value=None, priority=simpy.events.NORMAL):
+        if delay < 0:
+            raise ValueError('Negative delay {}'.format(delay))
+        # inlined from Timeout.__init__(), which always schedules with NORMAL
+        self.env = env
+        self.callbacks = []
+        self._value = value
+        self._delay = delay
+        self._ok = True
+        env.schedule(self, priority, delay)
+
+
 class SimStopEvent(simpy.Event):
     """Event appropriate for stopping the simulation.
 
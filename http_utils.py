@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Shared HTTP client for OTP and OSRM requests
+
+@author: ai6644
+"""
+
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+class RouterClient(object):
+    """Keeps a pool of keep-alive connections to routers and counts calls, bytes and latency per endpoint.
+
+    Use module level router_client, it is configured by the Top component before the simulation starts.
+    The client may be used from several threads.
+    """
+
+    def __init__(self, pool_size=10, timeout=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = None
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._init_session()
+
+    def _init_session(self):
+        if self.session is not None:
+            self.session.close()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def configure(self, pool_size=None, timeout=None):
+        """Sets pool size and default timeout in seconds, None keeps the current value. Resets the connection pool"""
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if timeout is not None:
+            self.timeout = timeout
+        self._init_session()
+
+    def get(self, endpoint, url, params=None, timeout=None):
+        """Performs a GET request through the connection pool
+
+        :param endpoint: name of the endpoint to collect statistics for, e.g. 'otp' or 'osrm_route'
+        :param timeout: timeout of this call in seconds, the default one is used if None
+        """
+        start = time.time()
+        resp = self.session.get(url, params=params, timeout=timeout if timeout is not None else self.timeout)
+        latency = time.time() - start
+
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {'calls': 0, 'bytes': 0, 'latency': 0, 'max_latency': 0})
+            stats['calls'] += 1
+            stats['bytes'] += len(resp.content)
+            stats['latency'] += latency
+            stats['max_latency'] = max(stats.get('max_latency'), latency)
+        return resp
+
+    def get_stats(self):
+        """Returns a copy of statistics {endpoint: {'calls', 'bytes', 'latency', 'max_latency'}},
+        latency is a total time in seconds"""
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+    def close(self):
+        self.session.close()
+
+
+router_client = RouterClient()
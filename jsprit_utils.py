@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-"""A module to form input XML files for jsprit and parse XML output from it
+"""A module to form input files for jsprit, parse its output and to run jsprit as a daemon
 
 @author: ai6644
 """
 
 import csv
+import struct
+import subprocess
+import time
 import xml.etree.ElementTree as ET
 # from lxml import etree as ET
 import logging
 
 from sim_utils import JspritSolution, JspritAct, JspritRoute
 from sim_utils import DrtAct
+from const import VehicleCost as VC
+
+import numpy as np
 
 log = logging.getLogger(__name__)
 
@@ -254,3 +260,273 @@ class VRPReadWriter(object):
 
 
 jsprit_vrp_interface = VRPReadWriter()
+
+
+class BinaryReadWriter(object):
+    """Packs a VRP with its time-distance matrix into a compact binary message and reads a binary solution.
+    It replaces the XML problem, the CSV matrix and the XML solution when they are passed to jsprit daemon.
+
+    All numbers are little-endian. A problem message:
+        'DRTP', uint32 version
+        uint32 N, float32[N*N] durations, float32[N*N] distances, row by row, locations are geoids
+        uint32 number of vehicle types, for each:
+            int32 id, capacity dimensions, float64 fixed, distance, time and wait costs
+        uint32 number of vehicles, for each:
+            int32 id, int32 type id, int32 start location, int32 end location, float64 start time
+        uint32 number of services (onboard travelers), for each:
+            int32 id, int32 location, float64 duration, float64 tw start, float64 tw end, capacity dimensions
+        uint32 number of shipments (waiting travelers), for each:
+            int32 id, int32 pickup location, float64 pickup duration, int32 delivery location,
+            float64 delivery duration, float64 tw start, float64 tw end, capacity dimensions
+        uint32 number of initial routes, for each:
+            int32 vehicle id, float64 start time, uint32 number of acts, for each: uint8 act type, int32 job id
+    Capacity dimensions are uint32 number of dimensions followed by int32 index, int32 value pairs.
+    Act types are ActType constants.
+
+    A solution message:
+        'DRTS', uint32 version, float64 cost
+        uint32 number of routes, for each:
+            int32 vehicle id, float64 start time, float64 end time, uint32 number of acts, for each:
+            uint8 act type, int32 job id, float64 arrival time, float64 end time
+        uint32 number of unassigned jobs, int32 job id for each
+    """
+
+    VERSION = 1
+    PROBLEM_MAGIC = b'DRTP'
+    SOLUTION_MAGIC = b'DRTS'
+
+    def write_problem(self, vehicle_types, vehicles, vehicle_coords_times, shipment_persons, service_persons,
+                      coord_to_geoid, durations, distances):
+        """Packs the same problem as VRPReadWriter.write_vrp together with the time-distance matrix
+
+        :param durations: N by N matrix of travel times between geoids
+        :param distances: N by N matrix of travel distances between geoids
+        :return: bytes
+        """
+        durations = np.asarray(durations, dtype='<f4')
+        distances = np.asarray(distances, dtype='<f4')
+        parts = [self.PROBLEM_MAGIC, struct.pack('<II', self.VERSION, durations.shape[0]),
+                 durations.tobytes(), distances.tobytes()]
+
+        parts.append(struct.pack('<I', len(vehicle_types)))
+        for type_id, v_type in vehicle_types.items():
+            parts.append(struct.pack('<i', type_id))
+            parts.append(self._pack_dimensions(v_type.capacity_dimensions))
+            parts.append(struct.pack('<dddd', v_type.costs.get(VC.FIXED, 0), v_type.costs.get(VC.DISTANCE, 0),
+                                     v_type.costs.get(VC.TIME, 0), v_type.costs.get(VC.WAIT, 0)))
+
+        parts.append(struct.pack('<I', len(vehicles)))
+        for vehicle, coord_time in zip(vehicles, vehicle_coords_times):
+            parts.append(struct.pack('<iiiid', vehicle.id, vehicle.vehicle_type.id,
+                                     coord_to_geoid.get(coord_time[0]), coord_to_geoid.get(vehicle.return_coord),
+                                     coord_time[1]))
+
+        parts.append(struct.pack('<I', len(service_persons)))
+        for person in service_persons:
+            parts.append(struct.pack('<iiddd', person.id, coord_to_geoid.get(person.drt_leg.end_coord),
+                                     person.leaving_time, person.get_tw_left(), person.get_tw_right()))
+            parts.append(self._pack_dimensions(person.dimensions))
+
+        parts.append(struct.pack('<I', len(shipment_persons)))
+        for person in shipment_persons:
+            parts.append(struct.pack('<iididdd', person.id,
+                                     coord_to_geoid.get(person.drt_leg.start_coord), person.boarding_time,
+                                     coord_to_geoid.get(person.drt_leg.end_coord), person.leaving_time,
+                                     person.get_tw_left(), person.get_tw_right()))
+            parts.append(self._pack_dimensions(person.dimensions))
+
+        routes = []
+        for vehicle, coord_time in zip(vehicles, vehicle_coords_times):
+            acts = vehicle.get_acts_for_initial_route()
+            if len(acts) == 0:
+                continue
+            route = [struct.pack('<idI', vehicle.id, coord_time[1], len(acts))]
+            route += [struct.pack('<Bi', act.type, int(act.person.id)) for act in acts]
+            routes.append(b''.join(route))
+        parts.append(struct.pack('<I', len(routes)))
+        parts += routes
+
+        return b''.join(parts)
+
+    @staticmethod
+    def _pack_dimensions(dimensions):
+        items = sorted(dimensions.items())
+        return struct.pack('<I' + 'ii' * len(items), len(items), *[v for item in items for v in item])
+
+    def read_solution(self, data):
+        """Reads a binary solution of jsprit daemon
+        :return: JspritSolution or None if no route has been found
+        """
+        if data[:4] != self.SOLUTION_MAGIC:
+            raise Exception('Unexpected binary solution header {}'.format(data[:4]))
+        version, cost, n_routes = struct.unpack_from('<IdI', data, 4)
+        if version != self.VERSION:
+            raise Exception('Unsupported binary solution version {}'.format(version))
+        offset = 4 + struct.calcsize('<IdI')
+
+        routes = []
+        for _ in range(n_routes):
+            vehicle_id, start_time, end_time, n_acts = struct.unpack_from('<iddI', data, offset)
+            offset += struct.calcsize('<iddI')
+            acts = []
+            for act_type, person_id, arrival_time, end_time_act in struct.iter_unpack('<Bidd',
+                                                                                       data[offset:offset + n_acts *
+                                                                                            struct.calcsize('<Bidd')]):
+                acts.append(JspritAct(type_=act_type, person_id=person_id,
+                                      end_time=end_time_act, arrival_time=arrival_time))
+            offset += n_acts * struct.calcsize('<Bidd')
+            routes.append(JspritRoute(vehicle_id=vehicle_id, start_time=start_time, end_time=end_time, acts=acts))
+
+        n_unassigned, = struct.unpack_from('<I', data, offset)
+        offset += struct.calcsize('<I')
+        unassigned = list(struct.unpack_from('<{}i'.format(n_unassigned), data, offset))
+
+        # the same as an XML solution without routes
+        if len(routes) == 0:
+            return None
+        return JspritSolution(cost=cost, routes=routes, unassigned=unassigned)
+
+
+jsprit_binary_interface = BinaryReadWriter()
+
+
+class JspritDaemon(object):
+    """A long-lived jsprit process that is started once and kept warm for the whole simulation.
+
+    In text mode problems are passed over the stdin of the process, one line per problem.
+    The line holds the same arguments as the ones given to DRT_test, separated with tabs.
+    The daemon answers with a single line: 'OK' when the solution is written to the output file,
+    or 'ERROR <message>' otherwise.
+
+    In binary mode a problem is sent as uint32 length followed by a problem message of BinaryReadWriter.
+    The daemon answers with uint8 status (0 on success), uint32 length and a solution message
+    or a utf-8 error message. Nothing is written to disk.
+
+    If the process has died, it is restarted and the problem is sent again.
+    """
+
+    def __init__(self, command, log_file=None, binary=False):
+        """
+        :param command: list with a command to start the daemon
+        :param log_file: stderr of the daemon is appended to this file
+        :param binary: use binary protocol instead of text lines
+        """
+        self.command = command
+        self.log_file = log_file
+        self.binary = binary
+        self.process = None
+        self._log = None
+        self.restarts = 0
+
+    def start(self):
+        if self.log_file is not None:
+            self._log = open(self.log_file, 'a')
+        self.process = subprocess.Popen(self.command,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=self._log if self._log is not None else subprocess.DEVNULL,
+                                        universal_newlines=not self.binary, bufsize=-1 if self.binary else 1)
+        log.info('jsprit daemon started with pid {}'.format(self.process.pid))
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def restart(self):
+        log.error('jsprit daemon has died with return code {}. Restarting it.'
+                  .format(self.process.returncode if self.process is not None else None))
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def solve(self, arguments):
+        """Sends one problem to the daemon in text mode and waits for an answer
+
+        :param arguments: list of jsprit arguments
+        :return: return code (0 on success) and error message
+        """
+        return self._call(self._exchange_line, arguments)
+
+    def solve_binary(self, problem):
+        """Sends one binary problem to the daemon and waits for an answer
+
+        :param problem: bytes from BinaryReadWriter.write_problem
+        :return: return code (0 on success) and a binary solution or an error message
+        """
+        return self._call(self._exchange_binary, problem)
+
+    def _call(self, exchange, request):
+        start = time.time()
+        for attempt in range(2):
+            if not self.is_alive():
+                self.restart()
+            try:
+                answer = exchange(request)
+            except (BrokenPipeError, OSError) as e:
+                log.error('Lost connection to jsprit daemon: {}'.format(e))
+                answer = None
+
+            if answer is None:
+                # the daemon has crashed during the solution, the problem is sent again to a new one
+                self.process.wait()
+                continue
+
+            log.debug('jsprit daemon solution takes {}'.format(time.time() - start))
+            return answer
+
+        return 1, 'jsprit daemon has crashed twice on the same problem'
+
+    def _exchange_line(self, arguments):
+        self.process.stdin.write('\t'.join([str(a) for a in arguments]) + '\n')
+        self.process.stdin.flush()
+        answer = self.process.stdout.readline()
+        if answer == '':
+            return None
+
+        answer = answer.rstrip('\n')
+        if answer == 'OK':
+            return 0, ''
+        else:
+            return 1, answer[len('ERROR'):].strip()
+
+    def _exchange_binary(self, problem):
+        self.process.stdin.write(struct.pack('<I', len(problem)))
+        self.process.stdin.write(problem)
+        self.process.stdin.flush()
+
+        header = self._read_exactly(struct.calcsize('<BI'))
+        if header is None:
+            return None
+        status, length = struct.unpack('<BI', header)
+        body = self._read_exactly(length)
+        if body is None:
+            return None
+
+        if status == 0:
+            return 0, body
+        else:
+            return 1, body.decode('utf-8', 'replace')
+
+    def _read_exactly(self, size):
+        """Reads size bytes from the daemon, returns None if the daemon has closed its stdout"""
+        data = b''
+        while len(data) < size:
+            chunk = self.process.stdout.read(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                # the daemon exits when its stdin is closed
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except (BrokenPipeError, OSError):
+                pass
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        if self._log is not None:
+            self._log.close()
+            self._log = None
@@ -40,14 +40,23 @@ class TimeWindowsModeChoice(object):
         """
         :type alternatives: [Trip]
         """
-        times = []
-        for alt in alternatives:
-            if alt.main_mode in [OtpMode.CAR]:
-                times.append(alt.duration * self.person.time_window_multiplier + self.person.time_window_constant)
-            else:
-                times.append(alt.duration)
+        times = [self._get_choice_time(alt.main_mode, alt.duration) for alt in alternatives]
         return min(zip(times, alternatives), key=lambda x: x[0])[1]
 
+    def _get_choice_time(self, main_mode, duration):
+        if main_mode in [OtpMode.CAR]:
+            return duration * self.person.time_window_multiplier + self.person.time_window_constant
+        else:
+            return duration
+
+    def is_dominated(self, alternatives, main_mode, min_duration):
+        """Returns True if a trip of main_mode that takes at least min_duration cannot be chosen over alternatives.
+        Alternatives are placed before DRT trips, so they are chosen when times are equal.
+        """
+        times = [self._get_choice_time(alt.main_mode, alt.duration) for alt in alternatives
+                 if self.satisfies_hard_restrictions(alt)]
+        return len(times) > 0 and self._get_choice_time(main_mode, min_duration) >= min(times)
+
 
 class DefaultModeChoice(object):
     """Supposed to be using MNL, but takes DRT if possible with 99.9%"""
@@ -78,6 +87,10 @@ class DefaultModeChoice(object):
         else:
             return True
 
+    def is_dominated(self, alternatives, main_mode, min_duration):
+        """A DRT trip is always chosen when there is one, see montecarlo"""
+        return False
+
     @staticmethod
     def calc_utility(trip):
         """Pretty much random numbers so far
@@ -4,15 +4,23 @@
 """
 
 import logging
+from collections import deque
 from datetime import timedelta as td
 import json
+import os
+import time
 from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 
 from desmod.component import Component
 import behaviour
 import mode_choice
+import routing
 
 from sim_utils import Activity, Coord, seconds_from_str, Trip, Leg, Step
+from population_utils import read_json_lists, get_travel_type, PopulationCache
 from const import ActivityType as actType
 from const import maxLat, minLat, maxLon, minLon
 from const import CapacityDimensions as CD
@@ -21,6 +29,17 @@ from log_utils import TravellerEventType
 
 log = logging.getLogger(__name__)
 
+# lists of the population file that are simulated in each population.scenario, in the order persons are sampled
+SCENARIO_LISTS = {
+    'all_within': ['population_within_pt', 'population_within_other'],
+    'pt_only': ['population_within_pt', 'population_in_pt', 'population_out_pt'],
+    'drtable_all': ['population_within_pt', 'population_within_other', 'population_in_pt', 'population_out_pt',
+                    'population_in_drtable', 'population_out_drtable'],
+    'drtable_outside': ['population_in_pt', 'population_out_pt', 'population_in_drtable', 'population_out_drtable'],
+    'all': ['population_within_pt', 'population_within_other', 'population_in_pt', 'population_out_pt',
+            'population_in_drtable', 'population_out_drtable', 'population_in_other', 'population_out_other'],
+}
+
 
 class Population(Component):
     """Population stores all the persons
@@ -31,12 +50,134 @@ class Population(Component):
     def __init__(self, *args, **kwargs):
         super(Population, self).__init__(*args, **kwargs)
         self.person_list = []
+        # person id -> Person, filled by add_person
+        self.persons_by_id = {}
+        self.serviceProvider = None
+        self.add_connections('serviceProvider')
+        # with population.activation_lead, (attributes, activities) of persons that are created during the simulation
+        self._person_records = []
+        # (activation time, attributes, activities) sorted by activation time
+        self._pending_persons = deque()
+        # person id -> PersonResult of persons that have left the simulation with population.activation_lead
+        self._person_results = {}  # type: Dict[int, PersonResult]
+        # (origin coord, destination coord) -> (duration, distance)
+        self._direct_trip_estimates = {}
+        # population files repeat the same times and coordinates for many activities,
+        # they are parsed once and Coord objects are shared
+        self._seconds_by_str = {}
+        self._coords_by_str = {}
         self._init_persons()
+        if self.env.config.get('population.precompute_direct_trips'):
+            self._precompute_direct_trips()
+        if self.env.config.get('population.activation_lead') is not None:
+            self._schedule_activations()
+            self.add_process(self._activate_persons)
 
     def _init_persons(self):
         # self.read_json()
         self.read_split_json()
-        log.info('{}: Population of {} persons created.'.format(self.env.now, len(self.person_list)))
+        log.info('{}: Population of {} persons created, {} will be created during the simulation.'
+                 .format(self.env.now, len(self.person_list), len(self._person_records)))
+
+    def _schedule_activations(self):
+        """Sorts person records by the time they are created at.
+
+        A person is created population.activation_lead seconds before it plans its first trip, so that it plans
+        at the same time as a person created at the start. Planning time depends on the duration of a direct trip,
+        persons without a precomputed direct trip are created at the start.
+
+        A person that reaches its final state is replaced by a PersonResult, persons that would be created after
+        the end of the simulation only get an empty PersonResult. Person components exist only for active persons.
+        """
+        lead = self.env.config.get('population.activation_lead')
+        activation_times = [max(0, self._get_planning_time(attributes, activities) - lead)
+                            for attributes, activities in self._person_records]
+        order = sorted(range(len(self._person_records)), key=activation_times.__getitem__)
+        self._pending_persons = deque((activation_times[i],) + self._person_records[i] for i in order)
+        self._person_records = []
+
+    def _get_planning_time(self, attributes, activities):
+        """Returns the time a person will plan its first trip at, or 0 if it is not known in advance"""
+        if len(activities) < 2 or activities[1].start_time is None:
+            return 0
+        estimate = self.get_direct_trip_estimate(activities[0].coord, activities[1].coord)
+        if estimate is None:
+            return 0
+        travel_type = attributes.get('travel_type') or \
+            get_travel_type(activities[0].zone, activities[1].zone, self.env.config.get('drt.zones')) or \
+            TravelType.WITHIN
+        multiplier, constant = Person.get_time_window_attributes(self.env.config, travel_type)
+        return activities[1].start_time - Person.get_pre_trip_time(self.env.config, activities[1], estimate[0],
+                                                                     multiplier, constant)
+
+    def _activate_persons(self):
+        while self._pending_persons:
+            activation_time, attributes, activities = self._pending_persons[0]
+            if activation_time > self.env.now:
+                yield self.env.timeout(activation_time - self.env.now)
+            self._pending_persons.popleft()
+            person = Person(self, attributes, activities)
+            self.add_person(person)
+            self.connect(person, 'serviceProvider')
+            person.elaborate()
+
+    def _precompute_direct_trips(self):
+        """Requests durations and distances of all direct trips between consecutive activities
+        from OSRM table service.
+
+        Origins are split into tiles, each tile is requested with the destinations its origins need.
+        Tiles are requested in parallel.
+        """
+        start = time.time()
+        destinations_by_origin = {}
+        for activities in self._activity_chains():
+            for origin, destination in zip(activities[:-1], activities[1:]):
+                destinations_by_origin.setdefault(origin.coord, set()).add(destination.coord)
+
+        tile_size = self.env.config.get('population.direct_trip_tile_size')
+        origins = list(destinations_by_origin.keys())
+        tiles = []
+        for i in range(0, len(origins), tile_size):
+            tile_origins = origins[i:i + tile_size]
+            tile_destinations = list(set(d for o in tile_origins for d in destinations_by_origin.get(o)))
+            for j in range(0, len(tile_destinations), tile_size):
+                tiles.append((tile_origins, tile_destinations[j:j + tile_size]))
+
+        with ThreadPoolExecutor(max_workers=self.env.config.get('population.direct_trip_workers')) as executor:
+            matrices = list(executor.map(self._request_direct_trip_tile, tiles))
+
+        for (tile_origins, tile_destinations), matrix in zip(tiles, matrices):
+            if matrix is None:
+                continue
+            for origin, duration_row, distance_row in zip(tile_origins, *matrix):
+                for destination, duration, distance in zip(tile_destinations, duration_row, distance_row):
+                    if destination in destinations_by_origin.get(origin):
+                        self._direct_trip_estimates[(origin, destination)] = (duration, distance)
+
+        log.info('{} direct trips precomputed with {} OSRM table requests in {:.1f}s'
+                 .format(len(self._direct_trip_estimates), len(tiles), time.time() - start))
+
+    def _activity_chains(self):
+        """Yields activities of every person, including the ones that are not created yet"""
+        for person in self.person_list:
+            yield [person.curr_activity, person.next_activity] + person.activities
+        for attributes, activities in self._person_records:
+            yield activities
+
+    def _request_direct_trip_tile(self, tile):
+        origins, destinations = tile
+        try:
+            return routing.osrm_table_request(self.env.config, origins + destinations,
+                                              sources=range(len(origins)),
+                                              destinations=range(len(origins), len(origins) + len(destinations)))
+        except (requests.RequestException, ValueError) as e:
+            # these trips will be requested one by one during the simulation
+            log.warning('Could not precompute {}x{} direct trips: {}'.format(len(origins), len(destinations), e))
+            return None
+
+    def get_direct_trip_estimate(self, origin, destination):
+        """Returns precomputed (duration, distance) of a car trip or None if it was not precomputed"""
+        return self._direct_trip_estimates.get((origin, destination))
 
     def read_split_json(self):
         """Reads the population file of format
@@ -53,56 +194,53 @@ class Population(Component):
                           'population_in_other': [],
                           'population_out_other': []
              }
-        """
-        with open(self.env.config.get('population.input_file'), 'r') as input_file:
-            raw_json = json.load(input_file)
-            pers_id = 0
 
-            # ['all_within', 'pt_only', 'drtable_all', 'drtable_outside']
-
-            if self.env.config.get('population.scenario') == 'all_within':
-                persons = raw_json.get('population_within_pt') + \
-                          raw_json.get('population_within_other')
-            elif self.env.config.get('population.scenario') == 'pt_only':
-                persons = raw_json.get('population_within_pt') + \
-                          raw_json.get('population_in_pt') + \
-                          raw_json.get('population_out_pt')
-            elif self.env.config.get('population.scenario') == 'drtable_all':
-                persons = raw_json.get('population_within_pt') + \
-                          raw_json.get('population_within_other') + \
-                          raw_json.get('population_in_pt') + \
-                          raw_json.get('population_out_pt') + \
-                          raw_json.get('population_in_drtable') + \
-                          raw_json.get('population_out_drtable')
-            elif self.env.config.get('population.scenario') == 'drtable_outside':
-                persons = raw_json.get('population_in_pt') + \
-                          raw_json.get('population_out_pt') + \
-                          raw_json.get('population_in_drtable') + \
-                          raw_json.get('population_out_drtable')
-            elif self.env.config.get('population.scenario') == 'all':
-                log.warning("Careful, importing the whole population file, it make take a lot of time!")
-                persons = raw_json.get('population_within_pt') + \
-                          raw_json.get('population_within_other') + \
-                          raw_json.get('population_in_pt') + \
-                          raw_json.get('population_out_pt') + \
-                          raw_json.get('population_in_drtable') + \
-                          raw_json.get('population_out_drtable') + \
-                          raw_json.get('population_in_other') + \
-                          raw_json.get('population_out_other')
+        The file is read incrementally, only the lists of population.scenario are decoded.
+        Unless population.cache_folder is None, the lists are saved to a PopulationCache once
+        and later runs read persons from the cache.
+        """
+        scenario = self.env.config.get('population.scenario')
+        if scenario not in SCENARIO_LISTS:
+            log.critical("Input population is configured wrong!."
+                         "Use population.scenario "
+                         "['all_within', 'pt_only', 'drtable_all', 'drtable_outside', 'all']")
+            raise Exception()
+        if scenario == 'all':
+            log.warning("Careful, importing the whole population file, it make take a lot of time!")
+
+        input_file = self.env.config.get('population.input_file')
+        cache_folder = self.env.config.get('population.cache_folder')
+        if cache_folder is None:
+            with open(input_file, 'r') as f:
+                self._add_sampled_persons(read_json_lists(f, SCENARIO_LISTS[scenario]), self._person_args_from_json)
+            return
+
+        cache_file = PopulationCache.get_file(cache_folder, input_file, SCENARIO_LISTS[scenario],
+                                              self.env.config.get('drt.zones'))
+        if os.path.exists(cache_file):
+            cache = PopulationCache.load(cache_file)
+        else:
+            log.info('Building population cache {}'.format(cache_file))
+            with open(input_file, 'r') as f:
+                cache = PopulationCache.from_json(read_json_lists(f, SCENARIO_LISTS[scenario]),
+                                                  self.env.config.get('drt.zones'))
+            cache.save(cache_file)
+        self._add_sampled_persons(cache.iter_persons(), self._person_args_from_cache)
+
+    def _add_sampled_persons(self, raw_persons, person_args_from_raw):
+        """Adds population.input_percentage of persons, they are sampled in the order of the scenario lists,
+        the same as when the lists were concatenated. With population.activation_lead only records are kept"""
+        lazy = self.env.config.get('population.activation_lead') is not None
+        input_percentage = self.env.config.get('population.input_percentage')
+        pers_id = 0
+        for raw_pers in raw_persons:
+            if self.env.rand.choices([False, True], [input_percentage, 1 - input_percentage])[0]:
+                continue
+            elif lazy:
+                self._person_records.append(person_args_from_raw(raw_pers, pers_id))
             else:
-                log.critical("Input population is configured wrong!."
-                             "Use population.scenario "
-                             "['all_within', 'pt_only', 'drtable_all', 'drtable_outside', 'all']")
-                raise Exception()
-
-            for json_pers in persons:
-                if self.env.rand.choices([False, True],
-                                         [self.env.config.get('population.input_percentage'),
-                                          1 - self.env.config.get('population.input_percentage')])[0]:
-                    continue
-                else:
-                    self.person_list.append(self._person_from_json(json_pers, pers_id))
-                pers_id += 1
+                self.add_person(Person(self, *person_args_from_raw(raw_pers, pers_id)))
+            pers_id += 1
 
     def read_json(self):
         """Reads json input file and generates persons to simulate"""
@@ -123,9 +261,13 @@ class Population(Component):
                                               1 - self.env.config.get('population.input_percentage')])[0]:
                         continue
 
-                    self.person_list.append(pers)
+                    self.add_person(pers)
 
     def _person_from_json(self, json_pers, pers_id):
+        return Person(self, *self._person_args_from_json(json_pers, pers_id))
+
+    def _person_args_from_json(self, json_pers, pers_id):
+        """Returns attributes and activities of a person"""
         # if self.env.rand.choices([False, True],
         #                          [self.env.config.get('population.input_percentage'),
         #                          1 - self.env.config.get('population.input_percentage')])[0]:
@@ -144,11 +286,11 @@ class Population(Component):
             type_str = json_activity.get('type')
             type_ = actType.get_activity(type_str)
 
-            end_time = seconds_from_str(json_activity.get('end_time'))
-            start_time = seconds_from_str(json_activity.get('start_time'))
+            end_time = self._seconds_from_str(json_activity.get('end_time'))
+            start_time = self._seconds_from_str(json_activity.get('start_time'))
 
             coord_json = json_activity.get('coord')
-            coord = Coord(lat=float(coord_json.get('lat')), lon=float(coord_json.get('lon')))
+            coord = self._coord_from_str(coord_json.get('lat'), coord_json.get('lon'))
 
             zone = int(json_activity.get('zone'))
 
@@ -160,7 +302,37 @@ class Population(Component):
                          zone=zone
                          )
             )
-        return Person(self, attributes, activities)
+        return attributes, activities
+
+    def _person_args_from_cache(self, cached_pers, pers_id):
+        activities, travel_type = cached_pers
+        if len(activities) == 0:
+            raise Exception('No activities provided for a person.')
+
+        attributes = {'age': 22, 'id': pers_id, 'otp_parameters': {'arriveBy': True}}
+        if travel_type is not None:
+            attributes['travel_type'] = travel_type
+
+        return attributes, [Activity(type_=type_,
+                                     start_time=start_time,
+                                     end_time=end_time,
+                                     coord=self._coord_from_str(lat, lon),
+                                     zone=zone)
+                            for type_, start_time, end_time, lat, lon, zone in activities]
+
+    def _seconds_from_str(self, string):
+        seconds = self._seconds_by_str.get(string)
+        if seconds is None:
+            seconds = seconds_from_str(string)
+            self._seconds_by_str[string] = seconds
+        return seconds
+
+    def _coord_from_str(self, lat, lon):
+        coord = self._coords_by_str.get((lat, lon))
+        if coord is None:
+            coord = Coord(lat=float(lat), lon=float(lon))
+            self._coords_by_str[(lat, lon)] = coord
+        return coord
 
     def _random_persons(self):
         """Not used. Generates persons at random geographical points with default parameters"""
@@ -182,17 +354,57 @@ class Population(Component):
                                        minutes=self.env.rand.uniform(0, 59)).total_seconds()
                          )
             ]
-            self.person_list.append(Person(parent=self, attributes=attributes, activities=activities))
+            self.add_person(Person(parent=self, attributes=attributes, activities=activities))
 
         log.info("{}: Population size {0}".format(self.env.now, len(self.person_list)))
 
+    def add_person(self, person):
+        self.person_list.append(person)
+        self.persons_by_id[person.id] = person
+
     def get_person(self, id):
-        ids = [p.id for p in self.person_list]
-        return self.person_list[ids.index(id)]
+        return self.persons_by_id[id]
+
+    def release_person(self, person):
+        """Replaces a person that has left the simulation by its PersonResult"""
+        if self.persons_by_id.pop(person.id, None) is None:
+            return
+        self._person_results[person.id] = PersonResult.from_person(person)
+        self.person_list.remove(person)
+        self._children.remove(person)
 
     def get_result(self, result):
         super(Population, self).get_result(result)
-        result['total_persons'] = len(self.person_list)
+        # persons that would plan after the end of the simulation have no trips, they are not created
+        while self._pending_persons:
+            activation_time, attributes, activities = self._pending_persons.popleft()
+            self._person_results[attributes.get('id')] = PersonResult(attributes.get('id'))
+        persons = dict(self._person_results)
+        persons.update(self.persons_by_id)
+        result['Persons'] = [persons[pers_id] for pers_id in sorted(persons)]
+        result['total_persons'] = len(result['Persons'])
+
+
+class PersonResult(object):
+    """Trip results of a person that has left the simulation, kept instead of the Person component"""
+    __slots__ = ['id', 'executed_trips', 'planned_trips', 'direct_trips', 'drt_status']
+
+    def __init__(self, id, executed_trips=None, planned_trips=None, direct_trips=None, drt_status=None):
+        self.id = id
+        self.executed_trips = executed_trips if executed_trips is not None else []
+        self.planned_trips = planned_trips if planned_trips is not None else []
+        self.direct_trips = direct_trips if direct_trips is not None else []
+        self.drt_status = drt_status if drt_status is not None else []
+
+    @classmethod
+    def from_person(cls, person):
+        return cls(person.id, person.executed_trips, person.planned_trips, person.direct_trips, person.drt_status)
+
+    def dumps(self):
+        return {'actual_trips': self.executed_trips,
+                'planned_trips': self.planned_trips,
+                'direct_trips': self.direct_trips,
+                'id': self.id}
 
 
 class Person(Component):
@@ -215,6 +427,7 @@ class Person(Component):
         trip: pre-computed trip to execute (Not tested).
         """
         Component.__init__(self, parent=parent, index=attributes.get('id'))
+        self._population = parent
         self.serviceProvider = None
         self.add_connections('serviceProvider')
 
@@ -282,32 +495,29 @@ class Person(Component):
         self.otp_parameters.update({'arriveBy': self.is_arrive_by()})
 
     def _set_travel_type_and_time_window_attributes(self):
-        if self.curr_activity.zone in self.env.config.get('drt.zones') and \
-                self.next_activity.zone in self.env.config.get('drt.zones'):
-            m = self.env.config.get('pt.time_window_multiplier_within')
-            c = self.env.config.get('pt.time_window_constant_within')
-            t = TravelType.WITHIN
-        elif self.curr_activity.zone in self.env.config.get('drt.zones') and \
-                self.next_activity.zone not in self.env.config.get('drt.zones'):
-            m = self.env.config.get('pt.time_window_multiplier_out')
-            c = self.env.config.get('pt.time_window_constant_out')
-            t = TravelType.OUT
-        elif self.curr_activity.zone not in self.env.config.get('drt.zones') and \
-                self.next_activity.zone in self.env.config.get('drt.zones'):
-            m = self.env.config.get('pt.time_window_multiplier_in')
-            c = self.env.config.get('pt.time_window_constant_in')
-            t = TravelType.IN
-        else:
+        # travel type may be given in attributes, e.g. from a population cache
+        t = self.travel_type
+        if t is None:
+            t = get_travel_type(self.curr_activity.zone, self.next_activity.zone, self.env.config.get('drt.zones'))
+
+        if t is None:
             log.error('Cannot determine what time window attributes to assign to a person.'
                       'Assigning default "within".'
                       'Person {}, activities'.format(self.id, self.activities))
-            m = self.env.config.get('pt.time_window_multiplier_within')
-            c = self.env.config.get('pt.time_window_constant_within')
             t = TravelType.WITHIN
 
         self.travel_type = t
-        self.time_window_multiplier = m
-        self.time_window_constant = c
+        self.time_window_multiplier, self.time_window_constant = self.get_time_window_attributes(self.env.config, t)
+
+    @staticmethod
+    def get_time_window_attributes(config, travel_type):
+        """Returns (multiplier, constant) of the time window of a travel type"""
+        if travel_type == TravelType.OUT:
+            return config.get('pt.time_window_multiplier_out'), config.get('pt.time_window_constant_out')
+        elif travel_type == TravelType.IN:
+            return config.get('pt.time_window_multiplier_in'), config.get('pt.time_window_constant_in')
+        else:
+            return config.get('pt.time_window_multiplier_within'), config.get('pt.time_window_constant_within')
 
     def save_travel_log(self):
         """Saves travel log to a file."""
@@ -322,16 +532,21 @@ class Person(Component):
         except OSError as e:
             log.critical(e.strerror)
 
+    def release(self):
+        """Called when a person has reached its final state.
+        With population.activation_lead, saves travel log and lets the population replace the person
+        with its PersonResult. Otherwise the person is kept until the results are collected."""
+        if self.env.config.get('population.activation_lead') is None:
+            return
+        self.save_travel_log()
+        self._population.release_person(self)
+
     def update_travel_log(self, event_type, *args):
         self.travel_log.append([self.env.time(), event_type, [*args]])
 
     def get_result(self, result):
-        """Save trip results to the result dictionary"""
+        """Saves travel log, trip results are collected by Population.get_result"""
         super(Person, self).get_result(result)
-        if 'Persons' not in result.keys():
-            result['Persons'] = []
-
-        result['Persons'].append(self)
         self.save_travel_log()
 
     def init_actual_trip(self):
@@ -354,11 +569,8 @@ class Person(Component):
         # pre_trip_time = max(trip.duration * self.env.config.get('drt.planning_in_advance_multiplier'),
         #                     self.env.config.get('drt.planning_in_advance'))
 
-        if self.is_arrive_by():
-            pre_trip_time = trip.duration * self.time_window_multiplier + self.time_window_constant +\
-                            self.env.config.get('drt.planning_in_advance')
-        else:
-            pre_trip_time = self.env.config.get('drt.planning_in_advance')
+        pre_trip_time = self.get_pre_trip_time(self.env.config, self.next_activity, trip.duration,
+                                               self.time_window_multiplier, self.time_window_constant)
 
         timeout = int((self.next_activity.start_time - pre_trip_time - self.env.now))
 
@@ -368,9 +580,17 @@ class Person(Component):
             timeout = 0
         return timeout
 
+    @staticmethod
+    def get_pre_trip_time(config, next_activity, trip_duration, multiplier, constant):
+        """Returns how many seconds before the start of the next activity a trip is planned"""
+        if next_activity.type == actType.WORK:
+            return trip_duration * multiplier + constant + config.get('drt.planning_in_advance')
+        else:
+            return config.get('drt.planning_in_advance')
+
     def update_actual_trip(self, steps: List[Step], end_coord):
         """When a vehicle completes an act or is being rerouted, save executed part to actual trip"""
-        self.actual_trip.legs[-1].steps += steps
+        self.actual_trip.legs[-1].steps += tuple(steps)
         self.actual_trip.legs[-1].duration += sum([s.duration for s in steps])
         self.actual_trip.legs[-1].distance += sum([s.distance for s in steps])
         self.actual_trip.legs[-1].end_coord = end_coord
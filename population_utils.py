@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Incremental reading of population files
+
+@author: ai6644
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+from const import ActivityType, TravelType
+from sim_utils import seconds_from_str
+
+log = logging.getLogger(__name__)
+
+# codes of activity and travel types in the population cache
+ACTIVITY_TYPES = list(ActivityType)
+TRAVEL_TYPES = list(TravelType)
+
+
+class JsonListStream(object):
+    """Reads a json file with a top level object of lists, e.g. {"population_in_pt": [...], ...},
+    without loading the whole file.
+
+    Elements of lists are decoded one at a time, elements of lists that are not requested are dropped.
+
+    Parameters
+    ----------
+    input_file : file object opened for reading text
+    keys : <iterable> of keys of the top level object to read
+    chunk_size : <int> number of characters read from the file at once
+    """
+
+    _WHITESPACE = re.compile(r'\s*')
+    _DELIMITERS = frozenset(' \t\n\r,:]}')
+
+    def __init__(self, input_file, keys, chunk_size=1 << 20):
+        self.input_file = input_file
+        self.keys = set(keys)
+        self.chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def lists(self):
+        """Yields (key, generator of elements) for the requested keys in the order they appear in the file.
+        A generator must be exhausted before the next key is taken.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._decode()
+            self._expect(':')
+            if key in self.keys:
+                self._expect('[')
+                yield key, self._elements()
+            else:
+                self._skip_value()
+            separator = self._next_char()
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError('Expected "," or "}}" at {}, got {}'.format(self._pos, separator))
+
+    def _elements(self):
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._decode()
+            separator = self._next_char()
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError('Expected "," or "]" at {}, got {}'.format(self._pos, separator))
+
+    def _fill(self):
+        """Reads the next chunk, drops the consumed part of the buffer. Returns False at the end of file"""
+        if self._eof:
+            return False
+        chunk = self.input_file.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            if self._pos < len(self._buf):
+                char = self._buf[self._pos]
+                if char not in ' \t\n\r':
+                    return char
+                self._pos = self._WHITESPACE.match(self._buf, self._pos).end()
+            elif not self._fill():
+                raise ValueError('Unexpected end of population file')
+
+    def _next_char(self):
+        char = self._peek()
+        self._pos += 1
+        return char
+
+    def _expect(self, char):
+        actual = self._next_char()
+        if actual != char:
+            raise ValueError('Expected "{}" at {}, got {}'.format(char, self._pos, actual))
+
+    def _decode(self):
+        """Decodes one json value, reads more of the file while the value is incomplete"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number may continue in the next chunk, e.g. "1." or "1.5e" are decoded as 1 or 1.5,
+                # so a value is complete only if it is followed by a delimiter
+                if self._eof or (end < len(self._buf) and self._buf[end] in self._DELIMITERS):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def _skip_value(self):
+        """Moves past one json value. Elements of a list are decoded one at a time and dropped,
+        which is faster than scanning brackets in python"""
+        if self._peek() == '[':
+            self._pos += 1
+            for _ in self._elements():
+                pass
+        else:
+            self._decode()
+
+
+def read_json_lists(input_file, keys):
+    """Yields elements of lists keys of a population file in the order of keys.
+
+    Lists are streamed when they appear in the file in the same order as in keys,
+    lists that appear earlier than their turn are kept in memory until it comes.
+    Missing lists are treated as empty.
+    """
+    keys = list(keys)
+    stream = JsonListStream(input_file, keys)
+    early = {}
+    position = 0
+    for key, elements in stream.lists():
+        if position < len(keys) and key == keys[position]:
+            yield from elements
+            position += 1
+            while position < len(keys) and keys[position] in early:
+                yield from early.pop(keys[position])
+                position += 1
+        else:
+            early[key] = list(elements)
+
+    for key in keys[position:]:
+        if key in early:
+            yield from early.pop(key)
+        else:
+            log.warning('Population file has no {} list'.format(key))
+
+
+def get_travel_type(zone_from, zone_to, drt_zones):
+    """Returns TravelType of a trip between two zones, or None if neither of the zones is a DRT zone"""
+    if zone_from in drt_zones:
+        return TravelType.WITHIN if zone_to in drt_zones else TravelType.OUT
+    elif zone_to in drt_zones:
+        return TravelType.IN
+    return None
+
+
+class PopulationCache(object):
+    """Persons of one scenario of a population file, stored column-wise in a NumPy .npz file.
+
+    Activities of all persons are kept in flat arrays, activities of person i are in
+    the range person_offsets[i]:person_offsets[i + 1]. Missing activity times are stored as -1.
+    Travel type of the first trip of every person is classified against drt.zones when the cache is built.
+
+    Cache file name includes a hash of the population file, the scenario lists and drt.zones,
+    so a cache is rebuilt whenever one of them changes.
+    """
+
+    VERSION = 1
+    COLUMNS = ('person_offsets', 'activity_types', 'start_times', 'end_times', 'lats', 'lons', 'zones',
+               'travel_types')
+
+    def __init__(self, **columns):
+        for column in self.COLUMNS:
+            setattr(self, column, columns[column])
+
+    def __len__(self):
+        return len(self.person_offsets) - 1
+
+    @classmethod
+    def get_file(cls, cache_folder, input_file, lists, drt_zones):
+        """Returns the path of a cache file for the population file, lists of a scenario and DRT zones"""
+        digest = hashlib.sha1()
+        with open(input_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(json.dumps([cls.VERSION, list(lists), sorted(drt_zones)]).encode())
+        return os.path.join(cache_folder, 'population-{}.npz'.format(digest.hexdigest()))
+
+    @classmethod
+    def from_json(cls, json_persons, drt_zones):
+        """Builds a cache from persons of a population file"""
+        drt_zones = set(drt_zones)
+        seconds_by_str = {None: -1}
+        offsets = [0]
+        activity_types = []
+        start_times = []
+        end_times = []
+        lats = []
+        lons = []
+        zones = []
+        travel_types = []
+        for json_pers in json_persons:
+            json_activities = json_pers.get('activities')
+            for json_activity in json_activities:
+                activity_types.append(ACTIVITY_TYPES.index(ActivityType.get_activity(json_activity.get('type'))))
+                for times, string in ((start_times, json_activity.get('start_time')),
+                                      (end_times, json_activity.get('end_time'))):
+                    if string not in seconds_by_str:
+                        seconds_by_str[string] = seconds_from_str(string)
+                    times.append(seconds_by_str[string])
+                coord_json = json_activity.get('coord')
+                lats.append(float(coord_json.get('lat')))
+                lons.append(float(coord_json.get('lon')))
+                zones.append(int(json_activity.get('zone')))
+            offsets.append(len(zones))
+
+            travel_type = None
+            if len(json_activities) > 1:
+                travel_type = get_travel_type(zones[offsets[-2]], zones[offsets[-2] + 1], drt_zones)
+            travel_types.append(TRAVEL_TYPES.index(travel_type) if travel_type is not None else -1)
+
+        return cls(person_offsets=np.array(offsets, dtype=np.int64),
+                   activity_types=np.array(activity_types, dtype=np.int8),
+                   start_times=np.array(start_times, dtype=np.int32),
+                   end_times=np.array(end_times, dtype=np.int32),
+                   lats=np.array(lats, dtype=np.float64),
+                   lons=np.array(lons, dtype=np.float64),
+                   zones=np.array(zones, dtype=np.int64),
+                   travel_types=np.array(travel_types, dtype=np.int8))
+
+    def save(self, cache_file):
+        """Writes the cache to a temporary file that replaces cache_file when complete"""
+        os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+        tmp_file = '{}.tmp.npz'.format(cache_file)
+        np.savez(tmp_file, **{column: getattr(self, column) for column in self.COLUMNS})
+        os.replace(tmp_file, cache_file)
+
+    @classmethod
+    def load(cls, cache_file):
+        with np.load(cache_file) as data:
+            return cls(**{column: data[column] for column in cls.COLUMNS})
+
+    def iter_persons(self):
+        """Yields (activities, travel type) of every person, activities are tuples
+        (ActivityType, start_time, end_time, lat, lon, zone) with None for missing times"""
+        offsets = self.person_offsets.tolist()
+        columns = zip([ACTIVITY_TYPES[code] for code in self.activity_types.tolist()],
+                      [t if t >= 0 else None for t in self.start_times.tolist()],
+                      [t if t >= 0 else None for t in self.end_times.tolist()],
+                      self.lats.tolist(),
+                      self.lons.tolist(),
+                      self.zones.tolist())
+        activities = list(columns)
+        for i, travel_type in enumerate(self.travel_types.tolist()):
+            yield (activities[offsets[i]:offsets[i + 1]],
+                   TRAVEL_TYPES[travel_type] if travel_type >= 0 else None)
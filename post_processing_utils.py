@@ -1,7 +1,7 @@
 from sim_utils import Coord, Trip, Step, Leg
 from const import OtpMode
 import json
-import requests
+from http_utils import router_client
 import logging
 import pprint
 import os
@@ -14,7 +14,10 @@ log = logging.getLogger(__name__)
 
 
 def _try(o):
-    return o.__dict__
+    try:
+        return o.dumps()
+    except AttributeError:
+        return o.__dict__
 
 
 class VisualTripWrapper(object):
@@ -69,7 +72,7 @@ def osrm_route_request(config, from_place, to_place):
         .format(config.get('service.osrm_route'),
                 from_place.lon, from_place.lat, to_place.lon, to_place.lat)
     url_full = url_coords + '?annotations=true&geometries=geojson&steps=true'
-    resp = requests.get(url=url_full)
+    resp = router_client.get('osrm_route', url_full)
     return _parse_osrm_response(resp)
 
 
@@ -83,9 +86,7 @@ def _parse_osrm_response(resp):
     #     log.error(jresp.get('message'))
     #     resp.raise_for_status()
 
-    trip = Trip()
-    trip.legs = [Leg()]
-    trip.legs[0].steps = []
+    route_steps = []
 
     legs = jresp.get('routes')[0].get('legs')
     for leg in legs:
@@ -99,17 +100,20 @@ def _parse_osrm_response(resp):
                                             lat=step.get('geometry').get('coordinates')[-1][1]))
             # OSRM makes circles on roundabouts. And makes empty step in the end. Exclude these cases from a route
             if new_step.start_coord != new_step.end_coord:
-                trip.legs[0].steps.append(new_step)
-        if len(trip.legs[0].steps) == 0:
+                route_steps.append(new_step)
+        if len(route_steps) == 0:
             waypoints = jresp.get('waypoints')
-            trip.legs[0].steps.append(Step(distance=0,
-                                           duration=0,
-                                           start_coord=Coord(lon=waypoints[0].get('location')[0],
-                                                             lat=waypoints[0].get('location')[1]),
-                                           end_coord=Coord(lon=waypoints[1].get('location')[0],
-                                                           lat=waypoints[1].get('location')[1])
-                                           )
-                                      )
+            route_steps.append(Step(distance=0,
+                                    duration=0,
+                                    start_coord=Coord(lon=waypoints[0].get('location')[0],
+                                                      lat=waypoints[0].get('location')[1]),
+                                    end_coord=Coord(lon=waypoints[1].get('location')[0],
+                                                    lat=waypoints[1].get('location')[1])
+                                    )
+                               )
+    trip = Trip()
+    trip.legs = [Leg()]
+    trip.legs[0].steps = route_steps
     trip.legs[0].start_coord = trip.legs[0].steps[0].start_coord
     trip.legs[0].end_coord = trip.legs[0].steps[-1].end_coord
     trip.legs[0].duration = sum([step.duration for step in trip.legs[0].steps])
@@ -171,7 +175,7 @@ def zipdir(path, ziph):
 def gather_logs(config, folder, res):
 
     log.info('Total {} persons'.format(res.get('total_persons')))
-    persons = res.get('Persons')  # List(Person)
+    persons = res.get('Persons')  # List(Person or PersonResult), sorted by id
     executed_trips = [trip for person in persons for trip in person.executed_trips]
     log.info('Executed trips: {}'.format(len(executed_trips)))
     log.info('Excluded persons due to none or a trivial path {}'
@@ -202,6 +206,38 @@ def gather_logs(config, folder, res):
     log.info('No walking leg to replace {}'.format(res.get('drt_one_leg')))
     log.info('Too long DRT_PT trip comparing to whole direct trip {}'.format(res.get('too_long_pt_trip')))
 
+    log.info('********************************************')
+    solve_times = res.get('jsprit_solve_times')
+    if solve_times:
+        log.info('jsprit solves {}, mean time {:.3f}s, max time {:.3f}s'
+                 .format(len(solve_times), sum(solve_times) / len(solve_times), max(solve_times)))
+    if res.get('drt_batches'):
+        log.info('DRT batches {}, requests in batches {}'.format(res.get('drt_batches'), res.get('drt_batched_requests')))
+    if res.get('drt_vehicles_filtered_out'):
+        log.info('Vehicles left out of DRT problems by candidate selection {}'
+                 .format(res.get('drt_vehicles_filtered_out')))
+    if res.get('drt_rejected_before_solver') is not None:
+        log.info('DRT requests rejected without solver call {}'.format(res.get('drt_rejected_before_solver')))
+    if res.get('drt_dominated_requests') is not None:
+        log.info('DRT requests not routed as DRT cannot win mode choice {}'.format(res.get('drt_dominated_requests')))
+    if res.get('kiss_ride_otp_requests') is not None:
+        log.info('DRT_TRANSIT OTP requests {}, saved by memo {}, by zone stop pre-screen {}'
+                 .format(res.get('kiss_ride_otp_requests'), res.get('kiss_ride_cache_hits'),
+                         res.get('kiss_ride_requests_prescreened')))
+    if res.get('jsprit_daemon_restarts') is not None:
+        log.info('jsprit daemon restarts {}'.format(res.get('jsprit_daemon_restarts')))
+    log.info('Time-distance matrix pairs fetched {}, reused {}, coordinates evicted {}'
+             .format(res.get('tdm_pairs_fetched'), res.get('tdm_pairs_reused'), res.get('tdm_coords_evicted')))
+    if res.get('otp_cache_hits') is not None:
+        log.info('OTP cache hits {}, misses {}'.format(res.get('otp_cache_hits'), res.get('otp_cache_misses')))
+    log.info('OSRM route calls avoided {} ({} from disk), performed {}'
+             .format(res.get('osrm_route_cache_hits'), res.get('osrm_route_cache_disk_hits'),
+                     res.get('osrm_route_cache_misses')))
+    for endpoint, stats in (res.get('http_stats') or {}).items():
+        log.info('{} calls {}, received {:.1f} MB, mean latency {:.3f}s, max latency {:.3f}s'
+                 .format(endpoint, stats.get('calls'), stats.get('bytes') / 1e6,
+                         stats.get('latency') / stats.get('calls'), stats.get('max_latency')))
+
     log.info('********************************************')
     log.info('Leg share :')
     for leg in leg_list:
@@ -15,29 +15,90 @@ import subprocess
 import time
 import json
 from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
-from population import *
 from const import OtpMode, LegMode
+from const import VehicleCost as VC
 from sim_utils import Trip, Leg, Coord, Step, trunc_microseconds, DrtAct, JspritSolution, otp_time_to_sec
+from sim_utils import JspritAct, JspritRoute, haversine_distance
 from db_utils import db_conn
-from jsprit_utils import jsprit_tdm_interface, jsprit_vrp_interface
+from jsprit_utils import jsprit_tdm_interface, jsprit_vrp_interface, jsprit_binary_interface, JspritDaemon
+from cache_utils import TimeDistanceMatrixCache, OtpCache, OsrmRouteCache
+from http_utils import router_client
 from exceptions import *
-import population
 
 import logging
 
 log = logging.getLogger(__name__)
 
 
+def osrm_table_request(config, coords, sources=None, destinations=None):
+    """Requests a time-distance matrix from OSRM table service.
+
+    :param sources: indices of coords to use as origins, all coords if None
+    :param destinations: indices of coords to use as destinations, all coords if None
+    :return: durations and distances as lists of rows, one row per source
+    """
+    url_coords = ';'.join([str(coord.lon) + ',' + str(coord.lat) for coord in coords])
+    url_server = config.get('service.osrm_tdm')
+    url_options = 'fallback_speed=9999999999&annotations=duration,distance'
+    if sources is not None:
+        url_options += '&sources=' + ';'.join([str(i) for i in sources])
+    if destinations is not None:
+        url_options += '&destinations=' + ';'.join([str(i) for i in destinations])
+    url_full = '{}{}?{}'.format(url_server, url_coords, url_options)
+    resp = router_client.get('osrm_table', url_full)
+
+    jresp = resp.json()
+    if jresp.get('code') != 'Ok':
+        log.error(jresp.get('code'))
+        log.error(jresp.get('message'))
+        resp.raise_for_status()
+
+    return jresp.get('durations'), jresp.get('distances')
+
+
 # TODO: refactor Default_routing so that it could be usable directly without service
+class DrtProblem(object):
+    """A DRT problem prepared for a solver: the state of the fleet it was built from, ids of coordinates
+    and the solver input, either jsprit files or data passed to the solver directly
+    """
+
+    def __init__(self, vehicles, vehicle_coords_times, shipment_persons, service_persons, coord_to_geoid,
+                 files=None, data=None):
+        self.vehicles = vehicles
+        self.vehicle_coords_times = vehicle_coords_times
+        self.shipment_persons = shipment_persons
+        self.service_persons = service_persons
+        self.coord_to_geoid = coord_to_geoid
+        self.files = files
+        self.data = data
+
+
 class DefaultRouting(object):
-    
+    # the solver takes everything from a prepared problem, so several problems may be solved at once
+    SUPPORTS_PARALLEL_SOLVERS = True
+
     def __init__(self, service):
         self.env = service.env
         self.url = self.env.config.get("service.router_address")
         # TODO: should remove this connection
         self.service = service
         self.coord_to_geoid = {}
+        self.jsprit_solve_times = []
+        self.tdm_cache = TimeDistanceMatrixCache(max_size=self.env.config.get('service.tdm_cache_size'))
+        self.otp_cache = self._open_otp_cache()
+        self.osrm_route_cache = OsrmRouteCache(max_size=self.env.config.get('service.osrm_route_cache_size'),
+                                               db_file=self.env.config.get('service.osrm_route_cache_file'))
+        # problems prepared with different slots are solved at once, see solve_drt_problems
+        self.parallel_solvers = 1
+        if self.SUPPORTS_PARALLEL_SOLVERS:
+            self.parallel_solvers = self.env.config.get('service.parallel_solvers') or 1
+        self._solver_executor = None
+        if self.parallel_solvers > 1:
+            self._solver_executor = ThreadPoolExecutor(max_workers=self.parallel_solvers)
 
     def otp_request(self,
                     from_place,
@@ -47,19 +108,61 @@ class DefaultRouting(object):
                     attributes=None):
         """Performs a web request to OTP and parses the output to a list of Trips
         Tries to repeat request if OTP exception has occured
+
+        If service.otp_cache_file is set, responses are taken from and saved to the on-disk cache
         """
+        key = None
+        if self.otp_cache is not None:
+            key = OtpCache.make_key(self._otp_params(from_place, to_place, at_time, mode, attributes),
+                                    self.env.config.get('date.unix_epoch'))
+            cached = self.otp_cache.get(key)
+            if cached is not None:
+                return self._from_otp_cache(cached)
 
         try:
-            return self._otp_request(from_place, to_place, at_time, mode, attributes)
-        except OTPGeneralRouting as e:
-            return self._otp_request(from_place, to_place, at_time, mode, attributes)
+            try:
+                trips = self._otp_request(from_place, to_place, at_time, mode, attributes)
+            except OTPGeneralRouting as e:
+                trips = self._otp_request(from_place, to_place, at_time, mode, attributes)
+        except (OTPNoPath, OTPTrivialPath) as e:
+            if key is not None:
+                self.otp_cache.put(key, (e.__class__.__name__, e.msg, e.context))
+            raise
+
+        if key is not None:
+            self.otp_cache.put(key, ('trips', trips))
+        return trips
 
-    def _otp_request(self,
-                     from_place,
-                     to_place,
-                     at_time,
-                     mode: str,
-                     attributes=None):
+    @staticmethod
+    def _from_otp_cache(cached):
+        """Returns trips saved in the OTP cache or raises the saved routing error"""
+        if cached[0] == 'trips':
+            return cached[1]
+        exception = {OTPNoPath.__name__: OTPNoPath, OTPTrivialPath.__name__: OTPTrivialPath}.get(cached[0])
+        raise exception(cached[1], cached[2])
+
+    def _open_otp_cache(self):
+        db_file = self.env.config.get('service.otp_cache_file')
+        if db_file is None:
+            return None
+
+        graph_key = self.env.config.get('service.otp_graph_key')
+        if graph_key is None:
+            # OTP router info is at the same address as the planner, e.g. /otp/routers/skane
+            info_url = self.url.rsplit('/plan', 1)[0]
+            try:
+                graph_key = router_client.get('otp_info', info_url).json().get('buildTime')
+            except (requests.RequestException, ValueError) as e:
+                log.warning('Cannot get OTP graph build time from {}: {}'.format(info_url, e))
+            if graph_key is None:
+                log.warning('OTP cache is disabled, since the graph cannot be identified. '
+                            'Set service.otp_graph_key to use the cache')
+                return None
+
+        log.info('Using OTP cache {} for graph {}'.format(db_file, graph_key))
+        return OtpCache(db_file, graph_key, max_size=self.env.config.get('service.otp_cache_size'))
+
+    def _otp_params(self, from_place, to_place, at_time, mode: str, attributes=None):
         default_attributes = {'fromPlace': str(from_place),
                               'toPlace': str(to_place),
                               'time': trunc_microseconds(str(td(seconds=at_time))),
@@ -69,7 +172,16 @@ class DefaultRouting(object):
                               'maxWalkDistance': 2000}
         if attributes is not None:
             default_attributes.update(attributes)
-        resp = requests.get(self.url, params=default_attributes)
+        return default_attributes
+
+    def _otp_request(self,
+                     from_place,
+                     to_place,
+                     at_time,
+                     mode: str,
+                     attributes=None):
+        default_attributes = self._otp_params(from_place, to_place, at_time, mode, attributes)
+        resp = router_client.get('otp', self.url, params=default_attributes)
         # payload = Payload(attributes=default_attributes, config=self.env.config)
 
         # resp = requests.get(self.url, params=payload.get_payload())
@@ -141,29 +253,26 @@ class DefaultRouting(object):
     def osrm_route_request(self, from_place, to_place):
         '''
         Requests and parses a Trip from OSRM between from_place and to_place
-        '''
 
+        Routes are memoized, returned trip has its own legs and list of steps, but Step objects are shared
+        '''
+        steps = self.osrm_route_cache.get(from_place, to_place)
+        if steps is None:
+            trip = self._osrm_route_request(from_place, to_place)
+            self.osrm_route_cache.put(from_place, to_place, trip.legs[0].steps)
+            return trip
+        return self._trip_from_steps(list(steps))
+
+    def _osrm_route_request(self, from_place, to_place):
         url_coords = '{}{},{};{},{}' \
             .format(self.env.config.get('service.osrm_route'),
                     from_place.lon, from_place.lat, to_place.lon, to_place.lat)
         url_full = url_coords + '?annotations=true&geometries=geojson&steps=true'
-        resp = requests.get(url=url_full)
+        resp = router_client.get('osrm_route', url_full)
         return self._parse_osrm_response(resp)
 
-    def _osrm_tdm_request(self, coords):
-        url_coords = ';'.join([str(coord.lon) + ',' + str(coord.lat) for coord in coords])
-        url_server = self.env.config.get('service.osrm_tdm')
-        url_options = 'fallback_speed=9999999999&annotations=duration,distance'
-        url_full = '{}{}?{}'.format(url_server, url_coords, url_options)
-        resp = requests.get(url=url_full)
-
-        jresp = resp.json()
-        if jresp.get('code') != 'Ok':
-            log.error(jresp.get('code'))
-            log.error(jresp.get('message'))
-            resp.raise_for_status()
-
-        return jresp.get('durations'), jresp.get('distances')
+    def _osrm_tdm_request(self, coords, sources=None, destinations=None):
+        return osrm_table_request(self.env.config, coords, sources, destinations)
 
     @staticmethod
     def _parse_osrm_response(resp):
@@ -176,9 +285,7 @@ class DefaultRouting(object):
             log.error(jresp.get('message'))
             resp.raise_for_status()
 
-        trip = Trip()
-        trip.legs = [Leg()]
-        trip.legs[0].steps = []
+        route_steps = []
 
         legs = jresp.get('routes')[0].get('legs')
         for leg in legs:
@@ -192,17 +299,25 @@ class DefaultRouting(object):
                                                 lat=step.get('geometry').get('coordinates')[-1][1]))
                 # OSRM makes circles on roundabouts. And makes empty step in the end. Exclude these cases from a route
                 if new_step.start_coord != new_step.end_coord:
-                    trip.legs[0].steps.append(new_step)
-            if len(trip.legs[0].steps) == 0:
+                    route_steps.append(new_step)
+            if len(route_steps) == 0:
                 waypoints = jresp.get('waypoints')
-                trip.legs[0].steps.append(Step(distance=0,
-                                               duration=0,
-                                               start_coord=Coord(lon=waypoints[0].get('location')[0],
-                                                                 lat=waypoints[0].get('location')[1]),
-                                               end_coord=Coord(lon=waypoints[1].get('location')[0],
-                                                               lat=waypoints[1].get('location')[1])
-                                               )
-                                          )
+                route_steps.append(Step(distance=0,
+                                        duration=0,
+                                        start_coord=Coord(lon=waypoints[0].get('location')[0],
+                                                          lat=waypoints[0].get('location')[1]),
+                                        end_coord=Coord(lon=waypoints[1].get('location')[0],
+                                                        lat=waypoints[1].get('location')[1])
+                                        )
+                                   )
+        return DefaultRouting._trip_from_steps(route_steps)
+
+    @staticmethod
+    def _trip_from_steps(steps):
+        """Forms a car trip with one DRT leg from a list of OSRM steps"""
+        trip = Trip()
+        trip.legs = [Leg()]
+        trip.legs[0].steps = steps
         trip.legs[0].start_coord = trip.legs[0].steps[0].start_coord
         trip.legs[0].end_coord = trip.legs[0].steps[-1].end_coord
         trip.legs[0].duration = sum([step.duration for step in trip.legs[0].steps])
@@ -214,9 +329,86 @@ class DefaultRouting(object):
         trip.main_mode = OtpMode.CAR
         return trip
 
-    def drt_request(self, person, vehicle_coords_times, return_vehicle_coords,
+    def drt_request(self, person, vehicles, vehicle_coords_times, return_vehicle_coords,
                     shipment_persons, service_persons):
-        """NOTE: person.drt_leg will be updated"""
+        """NOTE: person.drt_leg will be updated
+
+        :param vehicles: vehicles to route, routes of other vehicles are not changed
+        """
+        problem = self.prepare_drt_problem(vehicles, vehicle_coords_times, return_vehicle_coords,
+                                           shipment_persons, service_persons)
+        self.apply_drt_result(person, problem, self.solve_drt_problems([problem])[0])
+
+    def drt_batch_request(self, vehicles, vehicle_coords_times, return_vehicle_coords,
+                          shipment_persons, service_persons):
+        """Solves requests of several persons at once, persons are already included in shipment_persons.
+
+        Returns JspritSolution with all routes or None if solver failed.
+        Unlike drt_request, the solution is not applied, see ServiceProvider._commit_batch
+        """
+        problem = self.prepare_drt_problem(vehicles, vehicle_coords_times, return_vehicle_coords,
+                                           shipment_persons, service_persons)
+        return self._read_solution(problem, self.solve_drt_problems([problem])[0])
+
+    def solve_drt_problems(self, problems):
+        """Solves problems at once, each on its own solver, so problems must be prepared with different slots.
+        A single problem is solved in the calling thread.
+
+        Returns results of the solver in the order of problems, see apply_drt_result
+        """
+        rstate = self.env.rand.getstate()
+        if len(problems) <= 1:
+            results = [self._run_solver(problem) for problem in problems]
+        else:
+            if len(problems) > self.parallel_solvers:
+                raise ValueError('{} problems for {} solvers'.format(len(problems), self.parallel_solvers))
+            results = list(self._solver_executor.map(self._run_solver, problems, range(len(problems))))
+
+        if self.env.rand.getstate() != rstate:
+            log.warning('Random state has been changed by jsprit: {} to {}'.format(self.env.rand.getstate(), rstate))
+        self.env.rand.setstate(rstate)
+        return results
+
+    def apply_drt_result(self, person, problem, result):
+        """Reads a solution of a problem prepared for a request of a person and applies it
+
+        NOTE: person.drt_leg will be updated
+        """
+        solution = self._read_solution(problem, result)
+        if solution is not None and person.id in solution.unassigned:
+            self._save_unassigned_problem(person, problem)
+        self._apply_solution(person, solution)
+
+    def _save_unassigned_problem(self, person, problem):
+        file_id = 'vrp_{}_{}.xml'.format(str(time.time()), person.id)
+        copyfile(problem.files.get('vrp_file'), self.env.config.get('jsprit.debug_folder')+'/'+file_id)
+
+    def _get_jsprit_files(self, slot):
+        """Returns input and output files of jsprit for a slot. Slot 0 uses files from the config,
+        other slots add their number to the file names, to the log and to the picture folder,
+        so that solvers running at once do not write to the same files"""
+        files = {}
+        for name, key in [('vrp_file', 'jsprit.vrp_file'), ('tdm_file', 'jsprit.tdm_file'),
+                          ('vrp_solution', 'jsprit.vrp_solution'), ('sim_log', 'sim.log')]:
+            file_name = self.env.config.get(key)
+            if slot > 0:
+                root, extension = os.path.splitext(file_name)
+                file_name = '{}_{}{}'.format(root, slot, extension)
+            files[name] = file_name
+
+        picture_folder = self.env.config.get('drt.picture_folder')
+        if slot > 0:
+            picture_folder = os.path.join('{}_{}'.format(os.path.normpath(picture_folder), slot), '')
+            os.makedirs(picture_folder, exist_ok=True)
+        files['picture_folder'] = picture_folder
+        return files
+
+    def prepare_drt_problem(self, vehicles, vehicle_coords_times, return_vehicle_coords, shipment_persons,
+                            service_persons, slot=0):
+        """Calculates the time-distance matrix for the current state of the fleet and writes jsprit files of a slot.
+        Returns DrtProblem
+        """
+        files = self._get_jsprit_files(slot)
 
         # ***********************************************************
         # ************  Calculate time-distance matrix    ***********
@@ -241,49 +433,46 @@ class DefaultRouting(object):
         delivery_end_coord = [pers.drt_leg.end_coord for pers in service_persons]
 
         # TODO: catch the exceptions for TDM
-        self._calculate_time_distance_matrix(current_vehicle_coords, list(set(return_vehicle_coords)),
+        self._calculate_time_distance_matrix(files.get('tdm_file'),
+                                             current_vehicle_coords, list(set(return_vehicle_coords)),
                                              shipment_start_coords, shipment_end_coords, delivery_end_coord)
 
-        jsprit_vrp_interface.write_vrp(self.env.config.get('jsprit.vrp_file'),
-                                       self.service.vehicle_types, self.service.vehicles, vehicle_coords_times,
+        jsprit_vrp_interface.write_vrp(files.get('vrp_file'),
+                                       self.service.vehicle_types, vehicles, vehicle_coords_times,
                                        shipment_persons, service_persons, self.coord_to_geoid)
         log.debug('vrp file calculation takes {}'.format(time.time() - start))
+        return DrtProblem(vehicles, vehicle_coords_times, shipment_persons, service_persons, self.coord_to_geoid,
+                          files=files)
 
-        # ***********************************************************
-        # ************            Run jsprit              ***********
-        # ***********************************************************
-        start = time.time()
-        rstate = self.env.rand.getstate()
+    def _run_solver(self, problem, solver=0):
+        """Runs jsprit on a prepared problem. Problems of different solvers may be solved in parallel threads.
 
-        jsprit_call = subprocess.run(['java', '-Xmx1g', '-cp', 'jsprit.jar',
-                                      'com.graphhopper.jsprit.examples.DRT_test',
-                                      '-printSolution', self.env.config.get('drt.visualize_routes'),
-                                      '-vrpFile', self.env.config.get('jsprit.vrp_file'),
-                                      '-tdmFile', self.env.config.get('jsprit.tdm_file'),
-                                      '-outFile', self.env.config.get('jsprit.vrp_solution'),
-                                      '-simLog', self.env.config.get('sim.log'),
-                                      '-picFolder', self.env.config.get('drt.picture_folder'),
-                                      ],
-                                     capture_output=True)
+        Returns a return code, an answer of the solver and solution time
+        """
+        start = time.time()
+        returncode, stderr = self._run_jsprit(problem.files, solver)
+        return returncode, stderr, time.time() - start
 
-        if self.env.rand.getstate() != rstate:
-            log.warning('Random state has been changed by jsprit: {} to {}'.format(self.env.rand.getstate(), rstate))
-        self.env.rand.setstate(rstate)
+    def _read_solution(self, problem, result):
+        """Parses jsprit output for a result of _run_solver. Returns JspritSolution or None"""
+        returncode, stderr, solve_time = result
+        self.jsprit_solve_times.append(solve_time)
 
-        if jsprit_call.returncode != 0:
+        if returncode != 0:
             file_id = 'vrp.xml' + str(time.time())
             log.error("Jsprit has crashed. Saving input vrp to {}/{}"
                       .format(self.env.config.get('jsprit.debug_folder'), file_id))
-            log.error(jsprit_call.stderr.decode("utf-8") .replace('\\n', '\n'))
-            copyfile(self.env.config.get('jsprit.vrp_file'), self.env.config.get('jsprit.debug_folder')+'/'+file_id)
-        log.debug('jsprit takes {}ms of system time'.format(time.time() - start))
+            log.error(stderr.replace('\\n', '\n'))
+            copyfile(problem.files.get('vrp_file'), self.env.config.get('jsprit.debug_folder')+'/'+file_id)
+        log.debug('jsprit takes {}s of system time'.format(solve_time))
 
-        # ***********************************************************
-        # ************       Parse jsprit output          ***********
-        # ***********************************************************
-        solution = jsprit_vrp_interface.read_vrp_solution(self.env.config.get('jsprit.vrp_solution'))
-        # type: JspritSolution
+        return jsprit_vrp_interface.read_vrp_solution(problem.files.get('vrp_solution'))
+
+    def _apply_solution(self, person, solution):
+        """Checks that a person is assigned in a solution and saves the modified route as a pending request
 
+        NOTE: person.drt_leg will be updated
+        """
         # ***********************************************************
         # ************         Form a DRT trip            ***********
         # ***********************************************************
@@ -292,8 +481,6 @@ class DefaultRouting(object):
                                    'Check this.\n'
                                    'The person will ignore DRT mode.')
         if person.id in solution.unassigned:
-            file_id = 'vrp_{}_{}.xml'.format(str(time.time()), person.id)
-            copyfile(self.env.config.get('jsprit.vrp_file'), self.env.config.get('jsprit.debug_folder')+'/'+file_id)
             log.debug('Person {} cannot be delivered by DRT. Arrive by {}, tw left {}, tw right {}'
                       .format(person.id, person.next_activity.start_time, person.get_tw_left(), person.get_tw_right()))
             raise DrtUnassigned('Person {} cannot be delivered by DRT'.format(person.id))
@@ -315,6 +502,48 @@ class DefaultRouting(object):
         # TODO: calculate distance for all the changed trips (need to call OTP to extract the distance)
         self.service.pending_drt_requests[person.id] = solution
 
+    def _jsprit_arguments(self, files):
+        """Command line arguments of the jsprit solver, the same for a single run and for the daemon"""
+        return ['-printSolution', self.env.config.get('drt.visualize_routes'),
+                '-vrpFile', files.get('vrp_file'),
+                '-tdmFile', files.get('tdm_file'),
+                '-outFile', files.get('vrp_solution'),
+                '-simLog', files.get('sim_log'),
+                '-picFolder', files.get('picture_folder'),
+                ]
+
+    def _run_jsprit(self, files, solver=0):
+        """Starts a new JVM to solve the VRP written to files, see _get_jsprit_files
+
+        Returns a return code and stderr of jsprit
+        """
+        jsprit_call = subprocess.run(['java', '-Xmx1g', '-cp', 'jsprit.jar',
+                                      'com.graphhopper.jsprit.examples.DRT_test'] + self._jsprit_arguments(files),
+                                     capture_output=True)
+        return jsprit_call.returncode, jsprit_call.stderr.decode("utf-8")
+
+    def close(self):
+        """Releases resources held by the router. Called after the simulation"""
+        if self._solver_executor is not None:
+            self._solver_executor.shutdown()
+        if self.otp_cache is not None:
+            self.otp_cache.close()
+        self.osrm_route_cache.close()
+
+    def get_result(self, result):
+        result['jsprit_solves'] = len(self.jsprit_solve_times)
+        result['jsprit_solve_times'] = self.jsprit_solve_times
+        result['tdm_pairs_fetched'] = self.tdm_cache.fetched_pairs
+        result['tdm_pairs_reused'] = self.tdm_cache.reused_pairs
+        result['tdm_coords_evicted'] = self.tdm_cache.evicted_coords
+        result['http_stats'] = router_client.get_stats()
+        if self.otp_cache is not None:
+            result['otp_cache_hits'] = self.otp_cache.hits
+            result['otp_cache_misses'] = self.otp_cache.misses
+        result['osrm_route_cache_hits'] = self.osrm_route_cache.hits + self.osrm_route_cache.disk_hits
+        result['osrm_route_cache_disk_hits'] = self.osrm_route_cache.disk_hits
+        result['osrm_route_cache_misses'] = self.osrm_route_cache.misses
+
     @staticmethod
     def _get_person_route(person, solution):
         routes = solution.routes
@@ -329,7 +558,7 @@ class DefaultRouting(object):
         # TODO: what is a good name for this function?
         return self.osrm_route_request(coord_start, coord_end)
 
-    def _calculate_time_distance_matrix(self, vehicle_coords, return_coords,
+    def _calculate_time_distance_matrix(self, tdm_file, vehicle_coords, return_coords,
                                         shipment_start_coords, shipment_end_coords, delivery_end_coord):
         """Forms a time-distance matrix for jsprit.
 
@@ -339,7 +568,7 @@ class DefaultRouting(object):
 
         Output from OTP and a local database are merged into a one file.
         """
-        jsprit_tdm_interface.set_writer(self.env.config.get('jsprit.tdm_file'), 'w')
+        jsprit_tdm_interface.set_writer(tdm_file, 'w')
 
         # start = time.time()
         # coords_to_process_with_router = []
@@ -413,37 +642,97 @@ class DefaultRouting(object):
         #
         # coords_to_process_with_otp = list(set(coords_to_process_with_otp))
 
-        coords_to_process_with_router = set(vehicle_coords + return_coords +
-                                            shipment_start_coords + shipment_end_coords + delivery_end_coord)
+        coords_to_process_with_router = list(set(vehicle_coords + return_coords +
+                                                  shipment_start_coords + shipment_end_coords + delivery_end_coord))
         if len(coords_to_process_with_router) > 0:
             start = time.time()
 
-            durations, distances = self._osrm_tdm_request(coords_to_process_with_router)
+            self._update_tdm_cache(coords_to_process_with_router)
 
             log.debug('osrm tdm time {}'.format(time.time() - start))
 
-            # start = time.time()
-            # db_conn.insert_tdm_many(
-            #     [(coords[0].lat, coords[0].lon,
-            #       coords[1].lat, coords[1].lon,
-            #       row[2], row[3]) for source, destination in zip(coords_to_process_with_router, reader)])
-            # db_conn.commit()
-
-            to_db = []
-            for source, duration_row, distance_row in zip(coords_to_process_with_router, durations, distances):
-                for destination, duration, distance in zip(coords_to_process_with_router, duration_row, distance_row):
-                    # to_db.append((source.lat, source.lon,
-                    #               destination.lat, destination.lon,
-                    #               duration, distance))
+            for source in coords_to_process_with_router:
+                for destination in coords_to_process_with_router:
+                    duration, distance = self.tdm_cache.get(source, destination)
                     jsprit_tdm_interface.add_row_to_tdm(origin=self.coord_to_geoid.get(source),
                                                         destination=self.coord_to_geoid.get(destination),
                                                         time=duration, distance=distance)
-            # db_conn.insert_tdm_many(to_db)
-            # db_conn.commit()
-            # log.debug('saving to database time {}'.format(time.time() - start))
 
         jsprit_tdm_interface.close()
 
+    def _update_tdm_cache(self, coords):
+        """Fetches from OSRM only those pairs of coords that are missing from the time-distance matrix cache.
+
+        New coordinates and cached coordinates with incomplete rows get their full rows in one table request.
+        Columns of new coordinates for the remaining cached coordinates are fetched with a second request.
+        """
+        new_coords, incomplete_coords = self.tdm_cache.split_missing(coords)
+        fetched_before = self.tdm_cache.fetched_pairs
+
+        if len(new_coords) > 0 or len(incomplete_coords) > 0:
+            origins = new_coords + incomplete_coords
+            origins_set = set(origins)
+            complete_coords = [coord for coord in coords if coord not in origins_set]
+
+            ordered_coords = origins + complete_coords
+            durations, distances = self._osrm_tdm_request(ordered_coords, sources=range(len(origins)))
+            self.tdm_cache.add(origins, ordered_coords, durations, distances)
+
+            if len(complete_coords) > 0 and len(new_coords) > 0:
+                ordered_coords = complete_coords + new_coords
+                durations, distances = self._osrm_tdm_request(
+                    ordered_coords,
+                    sources=range(len(complete_coords)),
+                    destinations=range(len(complete_coords), len(ordered_coords)))
+                self.tdm_cache.add(complete_coords, new_coords, durations, distances)
+
+        self.tdm_cache.reused_pairs += len(coords)**2 - (self.tdm_cache.fetched_pairs - fetched_before)
+        self.tdm_cache.touch(coords)
+        if self.tdm_cache.is_full():
+            # a request may include only some vehicles (drt.candidate_vehicles) or two coordinates (get_travel_time),
+            # so coordinates of the whole fleet are kept as well
+            self.tdm_cache.evict(coords + self._get_referenced_coords())
+
+    def _get_referenced_coords(self):
+        """Returns coordinates that next DRT requests may include: current positions and return coordinates
+        of all vehicles, pick up and drop off coordinates of all scheduled travelers"""
+        coords = []
+        for vehicle in self.service.vehicles:
+            coords.append(vehicle.get_current_coord_time()[0])
+            coords.append(vehicle.return_coord)
+        for person in self.service.get_waiting_travelers() + self.service.get_onboard_travelers():
+            coords.append(person.drt_leg.start_coord)
+            coords.append(person.drt_leg.end_coord)
+        return coords
+
+    def get_travel_time(self, origin, destination):
+        """Returns driving time between two coordinates from the time-distance matrix cache.
+        A missing pair is requested from OSRM."""
+        if origin == destination:
+            return 0
+        cached = self.tdm_cache.get(origin, destination)
+        if cached is None:
+            self._update_tdm_cache([origin, destination])
+            cached = self.tdm_cache.get(origin, destination)
+        return cached[0]
+
+    def get_tdm_pair_counts(self):
+        """Returns numbers of time-distance pairs fetched from OSRM and reused from the cache so far"""
+        return self.tdm_cache.fetched_pairs, self.tdm_cache.reused_pairs
+
+    def discount_tdm_pairs(self, fetched, reused):
+        """Removes pairs of a problem that was prepared, but not used, from the counters of the cache"""
+        self.tdm_cache.fetched_pairs -= fetched
+        self.tdm_cache.reused_pairs -= reused
+
+    def get_travel_time_bound(self, origin, destination):
+        """Returns a lower bound of driving time between two coordinates without requesting OSRM.
+        Cached time is exact, otherwise great-circle distance is driven at drt.lower_bound_speed."""
+        cached = self.tdm_cache.get(origin, destination)
+        if cached is not None:
+            return cached[0]
+        return haversine_distance(origin, destination) / self.env.config.get('drt.lower_bound_speed')
+
     def _add_zero_length_connections(self, coords):
         """There may be requests from exactly the same points
         so we should allow jsprit to execute those sequentially"""
@@ -494,6 +783,294 @@ class DefaultRouting(object):
                         coords_to_process_with_otp.append((start_coord, end_coord))
 
 
+class DaemonRouting(DefaultRouting):
+    """Keeps one warm jsprit JVM for the whole simulation instead of starting a new one per DRT request.
+
+    Set service.routing to 'DaemonRouting' and jsprit.daemon_class to the jsprit main class that
+    serves problems over stdin/stdout (see jsprit_utils.JspritDaemon for the protocol).
+
+    With jsprit.exchange_format set to 'binary', problems and solutions are passed to the daemon over the pipe
+    in the format of jsprit_utils.BinaryReadWriter, without XML and CSV files.
+    XML problem is then written to jsprit.debug_folder only if jsprit fails or a person is unassigned.
+
+    With service.parallel_solvers above one, that many daemons are kept, one per solver.
+    """
+
+    def __init__(self, service):
+        super(DaemonRouting, self).__init__(service)
+        self.binary = self.env.config.get('jsprit.exchange_format') == 'binary'
+        command = ['java', '-Xmx1g', '-cp', 'jsprit.jar', self.env.config.get('jsprit.daemon_class')]
+        if self.binary:
+            command.append('-binary')
+        self.jsprit_daemons = [JspritDaemon(command=command,
+                                            log_file=self.env.config.get('jsprit.daemon_log'),
+                                            binary=self.binary)
+                               for _ in range(self.parallel_solvers)]
+        for jsprit_daemon in self.jsprit_daemons:
+            jsprit_daemon.start()
+
+    def prepare_drt_problem(self, vehicles, vehicle_coords_times, return_vehicle_coords, shipment_persons,
+                            service_persons, slot=0):
+        if not self.binary:
+            return super(DaemonRouting, self).prepare_drt_problem(vehicles, vehicle_coords_times,
+                                                                  return_vehicle_coords, shipment_persons,
+                                                                  service_persons, slot)
+
+        start = time.time()
+        self._prepare_geoid([ct[0] for ct in vehicle_coords_times] + return_vehicle_coords +
+                            [pers.drt_leg.start_coord for pers in shipment_persons] +
+                            [pers.drt_leg.end_coord for pers in shipment_persons + service_persons])
+        coords = sorted(self.coord_to_geoid.keys(), key=self.coord_to_geoid.get)
+        self._update_tdm_cache(coords)
+        durations = [[self.tdm_cache.get(o, d)[0] for d in coords] for o in coords]
+        distances = [[self.tdm_cache.get(o, d)[1] for d in coords] for o in coords]
+
+        problem = jsprit_binary_interface.write_problem(self.service.vehicle_types, vehicles,
+                                                        vehicle_coords_times, shipment_persons, service_persons,
+                                                        self.coord_to_geoid, durations, distances)
+        log.debug('binary problem of {} bytes takes {}'.format(len(problem), time.time() - start))
+        return DrtProblem(vehicles, vehicle_coords_times, shipment_persons, service_persons, self.coord_to_geoid,
+                          data=problem)
+
+    def _run_solver(self, problem, solver=0):
+        if not self.binary:
+            return super(DaemonRouting, self)._run_solver(problem, solver)
+        start = time.time()
+        returncode, answer = self.jsprit_daemons[solver].solve_binary(problem.data)
+        return returncode, answer, time.time() - start
+
+    def _read_solution(self, problem, result):
+        if not self.binary:
+            return super(DaemonRouting, self)._read_solution(problem, result)
+        returncode, answer, solve_time = result
+        self.jsprit_solve_times.append(solve_time)
+
+        if returncode != 0:
+            log.error("Jsprit has crashed. Saving input vrp to {}".format(self._dump_vrp('crash', problem)))
+            log.error(answer)
+            return None
+        return jsprit_binary_interface.read_solution(answer)
+
+    def _save_unassigned_problem(self, person, problem):
+        if not self.binary:
+            return super(DaemonRouting, self)._save_unassigned_problem(person, problem)
+        self._dump_vrp(person.id, problem)
+
+    def _dump_vrp(self, file_id, problem):
+        """Writes a problem as jsprit XML to the debug folder. Returns the file name"""
+        file_name = '{}/vrp_{}_{}.xml'.format(self.env.config.get('jsprit.debug_folder'), str(time.time()), file_id)
+        jsprit_vrp_interface.write_vrp(file_name, self.service.vehicle_types, problem.vehicles,
+                                       problem.vehicle_coords_times, problem.shipment_persons,
+                                       problem.service_persons, problem.coord_to_geoid)
+        return file_name
+
+    def _run_jsprit(self, files, solver=0):
+        return self.jsprit_daemons[solver].solve(self._jsprit_arguments(files))
+
+    def close(self):
+        super(DaemonRouting, self).close()
+        for jsprit_daemon in self.jsprit_daemons:
+            jsprit_daemon.stop()
+
+    def get_result(self, result):
+        super(DaemonRouting, self).get_result(result)
+        result['jsprit_daemon_restarts'] = sum(jsprit_daemon.restarts for jsprit_daemon in self.jsprit_daemons)
+
+
+class InsertionRouting(DefaultRouting):
+    """Solves DRT requests in-process with a cheapest insertion heuristic instead of jsprit.
+
+    Pickup and drop-off of a new traveler are inserted into the current route of every vehicle,
+    existing acts keep their order. All insertion positions of a vehicle are checked at once with numpy
+    against time windows and capacity dimensions, using durations and distances from the time-distance
+    matrix cache. Times follow jsprit: a vehicle waits until the start of a time window and must arrive
+    before its end. The insertion with the lowest additional cost, according to vehicle type costs, is taken.
+    Several new travelers of a batch are inserted one after another.
+
+    Set service.routing to 'InsertionRouting' to use it.
+    """
+    # travelers are read during the insertion, while a prepared problem only refers to them
+    SUPPORTS_PARALLEL_SOLVERS = False
+
+    def _save_unassigned_problem(self, person, problem):
+        """No problem file is written"""
+        pass
+
+    def prepare_drt_problem(self, vehicles, vehicle_coords_times, return_vehicle_coords, shipment_persons,
+                            service_persons, slot=0):
+        """Takes the time-distance matrix between all coordinates of the problem from the cache"""
+        coords = list(set([ct[0] for ct in vehicle_coords_times] + return_vehicle_coords +
+                          [pers.drt_leg.start_coord for pers in shipment_persons] +
+                          [pers.drt_leg.end_coord for pers in shipment_persons + service_persons]))
+        self._update_tdm_cache(coords)
+        coord_index = {coord: i for i, coord in enumerate(coords)}
+        durations = np.array([[self.tdm_cache.get(o, d)[0] for d in coords] for o in coords], dtype=float)
+        distances = np.array([[self.tdm_cache.get(o, d)[1] for d in coords] for o in coords], dtype=float)
+        return DrtProblem(vehicles, vehicle_coords_times, shipment_persons, service_persons, coord_index,
+                          data=(durations, distances))
+
+    def _run_solver(self, problem, solver=0):
+        """Inserts persons, that are not in vehicle routes yet, one by one in the order of shipment_persons"""
+        start = time.time()
+        vehicles = problem.vehicles
+        coord_index = problem.coord_to_geoid
+        durations, distances = problem.data
+
+        vehicle_acts = {vehicle.id: [(act.type, act.person) for act in vehicle.get_acts_for_initial_route()]
+                        for vehicle in vehicles}
+        routed_persons = set(act_person for acts in vehicle_acts.values() for _, act_person in acts)
+
+        routes = {}
+        cost = 0
+        unassigned = []
+        for person in problem.shipment_persons:
+            if person in routed_persons:
+                continue
+            best = None
+            for vehicle, coord_time in zip(vehicles, problem.vehicle_coords_times):
+                insertion = self._cheapest_insertion(person, vehicle, coord_time, vehicle_acts.get(vehicle.id),
+                                                     coord_index, durations, distances)
+                if insertion is not None and (best is None or insertion[0] < best[0]):
+                    best = insertion
+
+            if best is None:
+                unassigned.append(person.id)
+            else:
+                cost += best[0]
+                routes[best[1].vehicle_id] = best[1]
+                vehicle_acts[best[1].vehicle_id] = best[2]
+
+        solution = JspritSolution(cost=cost, routes=list(routes.values()), unassigned=unassigned)
+        return 0, solution, time.time() - start
+
+    def _read_solution(self, problem, result):
+        returncode, solution, solve_time = result
+        self.jsprit_solve_times.append(solve_time)
+        log.debug('insertion takes {}'.format(solve_time))
+        return solution
+
+    def _cheapest_insertion(self, person, vehicle, coord_time, route_acts, coord_index, durations, distances):
+        """Finds the cheapest feasible insertion of person's pickup and drop-off into the route of a vehicle
+
+        :param route_acts: current route of the vehicle as a list of (act type, person)
+        :return: (additional cost, JspritRoute, new list of (act type, person)) or None
+                 if the person cannot be inserted
+        """
+        dimensions = sorted(vehicle.vehicle_type.capacity_dimensions.keys())
+        capacity = np.array([vehicle.vehicle_type.capacity_dimensions.get(d) for d in dimensions], dtype=float)
+
+        # existing acts followed by the pickup and the drop-off of a new person
+        acts = route_acts + [(DrtAct.PICK_UP, person), (DrtAct.DROP_OFF, person)]
+        n = len(acts) - 2
+
+        locations = np.empty(n + 2, dtype=int)
+        tw_left = np.empty(n + 2)
+        tw_right = np.empty(n + 2)
+        service_times = np.empty(n + 2)
+        load_changes = np.zeros((n + 2, len(dimensions)))
+        initial_load = np.zeros(len(dimensions))
+        for k, (act_type, act_person) in enumerate(acts):
+            demand = np.array([act_person.dimensions.get(d, 0) for d in dimensions], dtype=float)
+            if act_type == DrtAct.PICK_UP:
+                locations[k] = coord_index.get(act_person.drt_leg.start_coord)
+                service_times[k] = act_person.boarding_time
+                load_changes[k] = demand
+            else:
+                locations[k] = coord_index.get(act_person.drt_leg.end_coord)
+                service_times[k] = act_person.leaving_time
+                load_changes[k] = -demand
+                # onboard travelers are loaded from the start, as jsprit does with services
+                if act_type == DrtAct.DELIVERY:
+                    initial_load += demand
+            tw_left[k] = act_person.get_tw_left()
+            tw_right[k] = act_person.get_tw_right()
+
+        start_location = coord_index.get(coord_time[0])
+        depot = coord_index.get(vehicle.return_coord)
+        costs = vehicle.vehicle_type.costs
+
+        # the current route may already be late, it is allowed to stay as late as it is, but not later
+        order = np.arange(n)[None, :]
+        base = self._simulate_routes(locations[order], tw_left[order], tw_right[order], service_times[order],
+                                     load_changes[order], initial_load, capacity, start_location, coord_time[1],
+                                     depot, durations, distances, costs)
+        tw_right[:n] = np.maximum(tw_right[:n], base[3][0])
+        base_cost = base[1][0]
+        if n == 0 and vehicle.get_route_len() == 0:
+            # jsprit adds fixed costs only for used vehicles
+            base_cost -= costs.get(VC.FIXED, 0)
+
+        # candidate (i, j): pickup goes to position i and drop-off to position j + 1 of a new route
+        i, j = np.triu_indices(n + 1)
+        i = i[:, None]
+        j = j[:, None]
+        p = np.arange(n + 2)[None, :]
+        order = np.where(p < i, p,
+                         np.where(p == i, n,
+                                  np.where(p <= j, p - 1,
+                                           np.where(p == j + 1, n + 1, p - 2))))
+
+        feasible, cost, end_time, arrival_times, end_times = self._simulate_routes(
+            locations[order], tw_left[order], tw_right[order], service_times[order], load_changes[order],
+            initial_load, capacity, start_location, coord_time[1], depot, durations, distances, costs)
+        if not feasible.any():
+            return None
+
+        cost = np.where(feasible, cost - base_cost, np.inf)
+        best = int(np.argmin(cost))
+
+        jsprit_acts = []
+        new_acts = []
+        for k in range(n + 2):
+            act_type, act_person = acts[order[best, k]]
+            new_acts.append((act_type, act_person))
+            jsprit_acts.append(JspritAct(type_=act_type, person_id=act_person.id,
+                                         end_time=float(end_times[best, k]),
+                                         arrival_time=float(arrival_times[best, k])))
+        route = JspritRoute(vehicle_id=vehicle.id, start_time=coord_time[1], end_time=float(end_time[best]),
+                            acts=jsprit_acts)
+        return float(cost[best]), route, new_acts
+
+    @staticmethod
+    def _simulate_routes(locations, tw_left, tw_right, service_times, load_changes, initial_load, capacity,
+                         start_location, start_time, depot, durations, distances, costs):
+        """Drives a vehicle along several candidate routes at once, one route per row of the input arrays
+
+        :return: feasibility, cost, arrival time to the depot, arrival times and end times of acts
+        """
+        n_routes, n_acts = locations.shape
+        feasible = np.ones(n_routes, dtype=bool)
+        t = np.full(n_routes, float(start_time))
+        previous = np.full(n_routes, start_location)
+        load = np.tile(initial_load, (n_routes, 1))
+        distance = np.zeros(n_routes)
+        waiting = np.zeros(n_routes)
+        arrival_times = np.empty((n_routes, n_acts))
+        end_times = np.empty((n_routes, n_acts))
+
+        for k in range(n_acts):
+            current = locations[:, k]
+            arrival = t + durations[previous, current]
+            feasible &= arrival <= tw_right[:, k]
+            begin = np.maximum(arrival, tw_left[:, k])
+            waiting += begin - arrival
+            load += load_changes[:, k]
+            feasible &= (load <= capacity).all(axis=1)
+            distance += distances[previous, current]
+            arrival_times[:, k] = arrival
+            end_times[:, k] = begin + service_times[:, k]
+            t = end_times[:, k]
+            previous = current
+
+        end_time = t + durations[previous, depot]
+        distance += distances[previous, depot]
+        cost = distance * costs.get(VC.DISTANCE, 0) + \
+            (end_time - start_time - waiting) * costs.get(VC.TIME, 0) + \
+            waiting * costs.get(VC.WAIT, 0) + \
+            costs.get(VC.FIXED, 0)
+        return feasible, cost, end_time, arrival_times, end_times
+
+
 class Payload(object):
     def __init__(self, attributes, config):
         self.fromPlace = attributes.get('fromPlace'),
@@ -10,6 +10,8 @@ from typing import List, Dict, Any
 import time
 import pandas
 import copy
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import routing
 
@@ -19,16 +21,53 @@ from simpy import Event
 from const import OtpMode, DrtStatus
 from const import maxLat, minLat, maxLon, minLon
 from const import CapacityDimensions as CD
-from sim_utils import Coord, JspritAct, Step, JspritSolution, JspritRoute, UnassignedTrip
+from sim_utils import Coord, JspritAct, Step, JspritSolution, JspritRoute, UnassignedTrip, haversine_distance
 from vehicle import Vehicle, VehicleType
-from sim_utils import ActType, DrtAct, Trip, Leg
+from sim_utils import ActType, DrtAct, Trip, Leg, DirectTrip
 from population import Person, Population
 from log_utils import TravellerEventType
 from exceptions import *
+from cache_utils import OtpCache, KissRideCache
 
 log = logging.getLogger(__name__)
 
 
+class DrtBatch(object):
+    """DRT requests that were solved together in one solver call.
+
+    Routes of the solution are committed to vehicles only after every assigned person has chosen a trip,
+    see ServiceProvider._commit_batch
+    """
+
+    def __init__(self, env, solution):
+        self.solution = solution  # type: JspritSolution
+        self.person_ids = set()
+        self.accepted = []  # type: List[Person]
+        self._undecided = set()
+        self.decided = env.event()
+
+    def get_route(self, person_id):
+        for route in self.solution.routes:
+            for act in route.acts:
+                if act.person_id == person_id:
+                    return route
+        return None
+
+    def add_person(self, person):
+        self.person_ids.add(person.id)
+        self._undecided.add(person.id)
+
+    def decide(self, person, accepted):
+        self._undecided.discard(person.id)
+        if accepted:
+            self.accepted.append(person)
+        self.check_decided()
+
+    def check_decided(self):
+        if len(self._undecided) == 0 and not self.decided.triggered:
+            self.decided.succeed()
+
+
 class ServiceProvider(Component):
     pending_drt_requests = None  # type: Dict[int, JspritSolution]
     vehicles = None  # type: List[Vehicle]
@@ -38,7 +77,15 @@ class ServiceProvider(Component):
         super(ServiceProvider, self).__init__(*args, **kwargs)
         self.vehicles = []
         self.vehicle_types = {}
-        self._zone_pt_stops = []
+        # travelers of each vehicle, kept up to date by vehicles, see update_route_index
+        self._waiting_persons = defaultdict(set)  # type: Dict[int, set]
+        self._boarding_persons = defaultdict(set)  # type: Dict[int, set]
+        self._onboard_persons = defaultdict(set)  # type: Dict[int, set]
+        self._alighting_persons = defaultdict(set)  # type: Dict[int, set]
+        self._zone_pt_stops = frozenset()
+        self._zone_pt_stop_coords = []  # type: List[Coord]
+        # lower bounds of driving time from a coordinate to the closest PT stop of the zone
+        self._zone_stop_time_bounds = {}  # type: Dict[Coord, float]
         self.pending_drt_requests = {}
 
         self.unassigned_trips = []
@@ -51,6 +98,12 @@ class ServiceProvider(Component):
         self._drt_too_short_trip = 0
         self._drt_too_late_request = 0
         self._drt_too_long_pt_trip = 0
+        self._drt_batches = 0
+        self._drt_batched_requests = 0
+        self._drt_vehicles_filtered_out = 0
+        self._drt_rejected_early = 0
+        self._drt_dominated_requests = 0
+        self._kiss_ride_requests_prescreened = 0
 
         self._unplannable_persons = 0
         self._unchoosable_persons = 0
@@ -59,11 +112,22 @@ class ServiceProvider(Component):
         router = self.env.config.get('service.routing')
         log.info('Setting router: {}'.format(router))
         self.router = getattr(routing, router)(self)
+        # OTP requests of one person are independent, so they are sent concurrently
+        self._otp_executor = ThreadPoolExecutor(max_workers=self.env.config.get('service.otp_workers'))
+        self._kiss_ride_cache = KissRideCache(max_size=self.env.config.get('service.kiss_ride_cache_size'))
 
         self._set_vehicle_types()
         self._init_vehicles()
         self._init_zone_pt_stops()
 
+        # DRT requests are collected during drt.batch_window seconds of simulation time and solved together
+        self.batch_window = self.env.config.get('drt.batch_window')
+        self._drt_batch = []  # type: List[tuple]
+        self._batch_of_person = {}  # type: Dict[int, DrtBatch]
+        self._decision_events = {}  # type: Dict[int, Event]
+        if self.batch_window:
+            self.add_process(self._batch_dispatcher)
+
         self.add_connections('population')
 
     def _init_vehicles(self):
@@ -102,45 +166,312 @@ class ServiceProvider(Component):
             #         })
 
     def _init_zone_pt_stops(self):
-        self._zone_pt_stops = pandas.read_csv(self.env.config.get('drt.PT_stops_file'), sep=',')['stop_id'].values
+        stops = pandas.read_csv(self.env.config.get('drt.PT_stops_file'), sep=',')
+        self._zone_pt_stops = frozenset(stops['stop_id'].tolist())
+        self._zone_pt_stop_coords = [Coord(lat=lat, lon=lon)
+                                     for lat, lon in zip(stops['stop_lat'].tolist(), stops['stop_lon'].tolist())]
 
     def is_stop_in_zone(self, stop_id):
         return stop_id in self._zone_pt_stops
 
+    def _zone_stop_time_bound(self, coord):
+        """Lower bound of driving time between coord and the closest PT stop of the zone,
+        great-circle distance is driven at drt.lower_bound_speed"""
+        bound = self._zone_stop_time_bounds.get(coord)
+        if bound is None:
+            distance = min((haversine_distance(coord, stop) for stop in self._zone_pt_stop_coords), default=0)
+            bound = distance / self.env.config.get('drt.lower_bound_speed')
+            self._zone_stop_time_bounds[coord] = bound
+        return bound
+
+    def _zone_stop_reachable(self, person: Person, params):
+        """Predicts if a DRT_TRANSIT trip with params can transfer at a PT stop of the zone.
+
+        Car part of a kiss and ride trip starts (or ride and kiss ends) at the activity inside the zone and cannot
+        be longer than maxPreTransitTime. If even the closest stop of the zone is further away,
+        all transfers found by OTP would be outside the zone.
+        """
+        if self.is_in_trip(person):
+            zone_coord = person.next_activity.coord
+        else:
+            zone_coord = person.curr_activity.coord
+        return self._zone_stop_time_bound(zone_coord) <= params.get('maxPreTransitTime')
+
+    def _kiss_ride_request(self, person: Person, mode, params):
+        """OTP request for DRT_TRANSIT, responses are memoized for the whole run in _kiss_ride_cache"""
+        key = OtpCache.make_key(params, person.curr_activity.coord, person.next_activity.coord,
+                                person.next_activity.start_time, mode)
+        trips = self._kiss_ride_cache.get(key)
+        if trips is not None:
+            return trips
+
+        try:
+            trips = self.router.otp_request(person.curr_activity.coord,
+                                            person.next_activity.coord,
+                                            person.next_activity.start_time,
+                                            mode,
+                                            params)
+        except OTPError as e:
+            self._kiss_ride_cache.put_error(key, e)
+            raise
+        return self._kiss_ride_cache.put(key, trips)
+
     def request(self, person: Person):
         log.info('Request came at {0} from {1}'.format(self.env.now, person))
 
+        transit_prefetch = self._prefetch_drt_transit(person)
+        traditional_alternatives = self._traditional_alternatives(person, transit_prefetch)
+        if self._drt_dominated(person, traditional_alternatives):
+            return self._merge_alternatives(person, traditional_alternatives, [])
+
+        start = time.time()
+        drt_alternatives = self._drt_alternatives(person, transit_prefetch)
+        log.debug('DRT request took {}'.format(time.time() - start))
+
+        return self._merge_alternatives(person, traditional_alternatives, drt_alternatives)
+
+    def batched_request(self, person: Person):
+        """Same as request, but the DRT part is answered at the end of the current batch window.
+        Must be called with yield from, returns alternatives.
+        """
+        log.info('Request came at {0} from {1}'.format(self.env.now, person))
+
+        traditional_alternatives = self._traditional_alternatives(person)
+        if self._drt_dominated(person, traditional_alternatives):
+            return self._merge_alternatives(person, traditional_alternatives, [])
+        resolved = self.env.event()
+        self._drt_batch.append((person, resolved))
+        drt_alternatives = yield resolved
+
+        return self._merge_alternatives(person, traditional_alternatives, drt_alternatives)
+
+    def _traditional_alternatives(self, person: Person, transit_prefetch=None):
+        """Returns traditional alternatives that start and end within the simulation"""
         start = time.time()
-        traditional_alternatives = self._traditional_request(person)
+        try:
+            traditional_alternatives = self._traditional_request(person)
+        except Exception:
+            if transit_prefetch is not None:
+                transit_prefetch.cancel()
+            raise
         log.debug('Web requests took {}'.format(time.time() - start))
 
+        if len(traditional_alternatives) == 0:
+            raise OTPUnreachable('No traditional alternatives received')
+
         traditional_alternatives2 = []
         for trip in traditional_alternatives:
             if trip.legs[0].start_time < self.env.now or trip.legs[-1].end_time > self.env.config['sim.duration_sec']:
                 continue
             else:
                 traditional_alternatives2.append(trip)
+        return traditional_alternatives2
 
-        start = time.time()
+    def _get_drt_duration_bound(self, person: Person):
+        """Returns a duration that a DRT trip of a person cannot beat or None if it is unknown.
 
-        if len(traditional_alternatives) == 0:
-            raise OTPUnreachable('No traditional alternatives received')
+        A local DRT trip cannot be faster than the direct car trip. DRT_TRANSIT trips are not bounded:
+        PT alternatives include waiting time that DRT_TRANSIT durations leave out,
+        and a kiss and ride request may find a faster transfer.
+        """
+        if self.is_local_trip(person):
+            return person.direct_trip.duration
+        return None
+
+    def _drt_dominated(self, person: Person, traditional_alternatives):
+        """Returns True if person.mode_choice cannot choose a DRT trip over traditional alternatives,
+        so that DRT routing is skipped"""
+        if not self.env.config.get('drt.prune_dominated_requests'):
+            return False
+        # too short trips are counted by _drt_request
+        if person.direct_trip.distance < self.env.config.get('drt.min_distance'):
+            return False
+
+        min_duration = self._get_drt_duration_bound(person)
+        if min_duration is None:
+            return False
+        if not person.mode_choice.is_dominated(traditional_alternatives, OtpMode.DRT, min_duration):
+            return False
+
+        log.info('Person {} cannot choose DRT that takes at least {}. Ignoring DRT'.format(person.id, min_duration))
+        self._drt_dominated_requests += 1
+        person.set_drt_status(DrtStatus.dominated)
+        return True
 
+    def _drt_alternatives(self, person: Person, transit_prefetch=None):
         try:
-            drt_alternatives, status = self._drt_request(person)
+            drt_alternatives, status = self._drt_request(person, transit_prefetch)
             person.set_drt_status(status)
         except OTPNoPath as e:
             log.warning('{}\n{}'.format(e.msg, e.context))
             log.warning('Person {} will not consider DRT'.format(person))
             drt_alternatives = []
+        return drt_alternatives
 
-        log.debug('DRT request took {}'.format(time.time() - start))
-        alternatives = traditional_alternatives2 + drt_alternatives
-
+    @staticmethod
+    def _merge_alternatives(person, traditional_alternatives, drt_alternatives):
+        alternatives = traditional_alternatives + drt_alternatives
         if len(alternatives) == 0:
             log.warning('no alternatives received by {}'.format(person.scope))
         return alternatives
 
+    def _batch_dispatcher(self):
+        """Answers DRT requests collected during each batch window.
+
+        Local trips of a batch are solved together in one solver call. DRT_TRANSIT trips need their own OTP
+        requests and solver calls, they are processed one by one afterwards, as without batching.
+        Next requests are not solved until persons have chosen their trips,
+        so that every solution is based on the routes that are actually committed.
+        """
+        while True:
+            yield self.env.timeout(self.batch_window)
+            if len(self._drt_batch) == 0:
+                continue
+            requests, self._drt_batch = self._drt_batch, []
+            self._drt_batches += 1
+            self._drt_batched_requests += len(requests)
+
+            joint_requests = [(person, resolved) for person, resolved in requests
+                              if self.is_local_trip(person)
+                              and person.direct_trip.distance >= self.env.config.get('drt.min_distance')]
+            if len(joint_requests) > 0:
+                yield from self._solve_batch(joint_requests)
+
+            joint_persons = set(person for person, _ in joint_requests)
+            for person, resolved in requests:
+                if person in joint_persons:
+                    continue
+                # triggered when the person chooses a trip or is excluded from the simulation
+                decided = self._decision_events[person.id] = self.env.event()
+                try:
+                    drt_alternatives = self._drt_alternatives(person)
+                except (OTPTrivialPath, OTPUnreachable) as e:
+                    # the person is excluded as without batching, see DefaultBehaviour.on_plan
+                    resolved.fail(e)
+                    yield decided
+                    continue
+                except OTPError as e:
+                    log.warning('{}\n{}'.format(e.msg, e.context))
+                    log.warning('Person {} will not consider DRT'.format(person))
+                    self._drt_undeliverable += 1
+                    person.set_drt_status(DrtStatus.undeliverable)
+                    drt_alternatives = []
+                resolved.succeed(drt_alternatives)
+                yield decided
+
+    def _solve_batch(self, requests):
+        """Solves local trips of a batch in one solver call and waits until persons choose their trips"""
+        persons = [person for person, _ in requests]
+        for person in persons:
+            self._set_local_drt_leg(person)
+
+        vehicles, vehicle_coords_times, vehicle_return_coords, waiting_persons, service_persons, filtered_out = \
+            self._get_fleet_state([person.drt_leg.start_coord for person in persons])
+        self._drt_vehicles_filtered_out += filtered_out
+
+        feasible_requests = []
+        for person, resolved in requests:
+            try:
+                self._check_feasibility(person, vehicles, vehicle_coords_times)
+                feasible_requests.append((person, resolved))
+            except DrtUnassigned as e:
+                log.warning(e.msg)
+                self._drt_unassigned += 1
+                person.set_drt_status(DrtStatus.unassigned)
+                resolved.succeed([])
+        if len(feasible_requests) == 0:
+            return
+        requests = feasible_requests
+        persons = [person for person, _ in requests]
+
+        batch = DrtBatch(self.env, self.router.drt_batch_request(vehicles, vehicle_coords_times, vehicle_return_coords,
+                                                                 waiting_persons + persons, service_persons))
+
+        for person, resolved in requests:
+            drt_trips, status = self._batch_assignment(person, batch)
+            person.set_drt_status(status)
+            resolved.succeed(drt_trips)
+
+        batch.check_decided()
+        yield batch.decided
+        self._commit_batch(batch)
+
+    def _batch_assignment(self, person: Person, batch: DrtBatch):
+        """Forms a DRT trip of a person from a batch solution. NOTE: person.drt_leg will be updated"""
+        if batch.solution is None:
+            log.warning('jsprit returned no solution for a batch. Person {} will ignore DRT mode.'.format(person.id))
+            self._drt_undeliverable += 1
+            return [], DrtStatus.undeliverable
+
+        route = batch.get_route(person.id)
+        if person.id in batch.solution.unassigned or route is None:
+            log.warning('Person {} cannot be delivered by DRT'.format(person.id))
+            self._drt_unassigned += 1
+            return [], DrtStatus.unassigned
+
+        acts = [act for act in route.acts if act.person_id == person.id]
+        person.drt_leg.duration = (acts[-1].arrival_time - acts[0].end_time)
+        batch.add_person(person)
+        self._batch_of_person[person.id] = batch
+
+        drt_trip = Trip()  # type: Trip
+        drt_trip.set_empty_trip(OtpMode.DRT, person.curr_activity.coord, person.next_activity.coord)
+        drt_trip.legs[0] = person.drt_leg.deepcopy()
+        drt_trip.duration = drt_trip.legs[0].duration
+        return [drt_trip], DrtStatus.routed
+
+    def _commit_batch(self, batch: DrtBatch):
+        """Sets routes of a batch solution to vehicles that serve at least one person who has chosen DRT.
+        Acts of persons who have chosen other trips are removed from these routes.
+        """
+        if batch.solution is None:
+            return
+        accepted_ids = set(person.id for person in batch.accepted)
+        declined_ids = batch.person_ids - accepted_ids
+        for jsprit_route in batch.solution.routes:
+            route_person_ids = set(act.person_id for act in jsprit_route.acts)
+            persons = [person for person in batch.accepted if person.id in route_person_ids]
+            if len(persons) == 0:
+                continue
+            vehicle = self.get_vehicle_by_id(jsprit_route.vehicle_id)  # type: Vehicle
+            if len(route_person_ids & declined_ids) > 0:
+                jsprit_route = self._remove_declined_acts(vehicle, jsprit_route, declined_ids)
+            self._reroute_vehicle(vehicle, jsprit_route, persons)
+
+    def _remove_declined_acts(self, vehicle, jsprit_route: JspritRoute, declined_ids):
+        """Removes acts of declined persons from a route and recalculates times of the remaining acts"""
+        coord = vehicle.get_current_coord_time()[0]
+        end_time = jsprit_route.start_time
+        acts = []
+        for jsprit_act in jsprit_route.acts:
+            if jsprit_act.person_id in declined_ids:
+                continue
+            person = self.population.get_person(jsprit_act.person_id)  # type: Person
+            if jsprit_act.type == ActType.PICK_UP:
+                next_coord = person.drt_leg.start_coord
+                duration = person.boarding_time
+            else:
+                next_coord = person.drt_leg.end_coord
+                duration = person.leaving_time
+            arrival_time = end_time + self.router.get_travel_time(coord, next_coord)
+            end_time = max(arrival_time, person.get_tw_left()) + duration
+            acts.append(JspritAct(type_=jsprit_act.type, person_id=jsprit_act.person_id,
+                                  end_time=end_time, arrival_time=arrival_time))
+            coord = next_coord
+
+        return JspritRoute(vehicle_id=jsprit_route.vehicle_id, start_time=jsprit_route.start_time,
+                           end_time=end_time + self.router.get_travel_time(coord, vehicle.return_coord),
+                           acts=acts)
+
+    def _person_decided(self, person: Person, accepted):
+        """Notifies the batch dispatcher that a person has chosen a trip"""
+        batch = self._batch_of_person.pop(person.id, None)
+        if batch is not None:
+            batch.decide(person, accepted)
+        decided = self._decision_events.pop(person.id, None)
+        if decided is not None:
+            decided.succeed()
+
     def is_local_trip(self, person):
         return person.curr_activity.zone in self.env.config.get('drt.zones') \
                and person.next_activity.zone in self.env.config.get('drt.zones')
@@ -171,15 +502,18 @@ class ServiceProvider(Component):
         else:
             raise Exception('service.modes configured incorrectly')
 
-        for mode in modes:
-            if mode in ['DRT']:
-                continue
+        # requests are sent at once, but their results and errors are processed in the order of modes
+        futures = [self._otp_executor.submit(self.router.otp_request,
+                                             person.curr_activity.coord,
+                                             person.next_activity.coord,
+                                             person.next_activity.start_time,
+                                             mode,
+                                             copy.copy(person.otp_parameters))
+                   for mode in modes if mode not in ['DRT']]
+
+        for future in futures:
             try:
-                traditional_alternatives += self.router.otp_request(person.curr_activity.coord,
-                                                                    person.next_activity.coord,
-                                                                    person.next_activity.start_time,
-                                                                    mode,
-                                                                    copy.copy(person.otp_parameters))
+                traditional_alternatives += future.result()
             except OTPNoPath as e:
                 log.warning('{}\n{}'.format(e.msg, e.context))
                 continue
@@ -190,13 +524,45 @@ class ServiceProvider(Component):
         else:
             return traditional_alternatives
 
-    def _drt_request(self, person: Person):
+    def _prefetch_drt_transit(self, person: Person):
+        """Starts the first OTP request of _drt_transit together with the traditional requests.
+
+        Returns a future with the result of the request or None if the person will not need it
+        """
+        if person.direct_trip.distance < self.env.config.get('drt.min_distance') \
+                or self.is_local_trip(person) \
+                or not (self.is_in_trip(person) or self.is_out_trip(person)):
+            return None
+        params = self._get_drt_transit_params(person)
+        if not self._zone_stop_reachable(person, params):
+            return None
+        return self._otp_executor.submit(self._kiss_ride_request, person, self._get_drt_transit_mode(person), params)
+
+    def _get_drt_transit_mode(self, person: Person):
+        if self.is_in_trip(person):
+            return OtpMode.RIDE_KISS
+        elif self.is_out_trip(person):
+            return OtpMode.KISS_RIDE
+        else:
+            raise Exception("Cannot determine if DRT+TRANSIT trip is going in or out service zone \n"
+                            "Check person's Origin-Destination \n"
+                            "{}".format(person))
+
+    def _get_drt_transit_params(self, person: Person):
+        # maxPreTransitTime parameters restricts the time on a car for kiss and ride (and ride and kiss)
+        params = copy.copy(person.otp_parameters)
+        params.update({'maxPreTransitTime': self.env.config.get('drt.maxPreTransitTime')})
+        return params
+
+    def _drt_request(self, person: Person, transit_prefetch=None):
         """Calculates a list of DRT possible trips.
         If a person moves within service zones, the whole trip is done wit drt as one leg.
 
         If a person moves in or out of service zones, drt will perform a first or last mile. DRT leg in this case will
         replace a walking leg, where walk speed is set to the car speed.
 
+        transit_prefetch is a future with the first OTP request for DRT_TRANSIT, see _prefetch_drt_transit
+
         Returns a list of drt trips and a status for logging
         """
 
@@ -208,19 +574,23 @@ class ServiceProvider(Component):
         if self.is_local_trip(person):
             drt_trips, status = self._drt_local(person)
         else:
-            drt_trips, status = self._drt_transit(person)
+            drt_trips, status = self._drt_transit(person, transit_prefetch)
 
         return drt_trips, status
 
-    def _drt_local(self, person: Person):
-        drt_trip = Trip()  # type: Trip
-        drt_trip.set_empty_trip(OtpMode.DRT, person.curr_activity.coord, person.next_activity.coord)
+    @staticmethod
+    def _set_local_drt_leg(person: Person):
         drt_leg = Leg(mode=OtpMode.DRT,
                       start_coord=person.curr_activity.coord,
                       end_coord=person.next_activity.coord)
         person.drt_leg = drt_leg.deepcopy()
         person.set_tw(person.direct_trip.duration, single_leg=True)
 
+    def _drt_local(self, person: Person):
+        drt_trip = Trip()  # type: Trip
+        drt_trip.set_empty_trip(OtpMode.DRT, person.curr_activity.coord, person.next_activity.coord)
+        self._set_local_drt_leg(person)
+
         try:
             self._drt_request_routine(person)
         except DrtUndeliverable as e:
@@ -236,21 +606,12 @@ class ServiceProvider(Component):
         drt_trip.duration = drt_trip.legs[0].duration
         return [drt_trip], DrtStatus.routed
 
-    def _drt_transit(self, person: Person):
+    def _drt_transit(self, person: Person, transit_prefetch=None):
 
-        # maxPreTransitTime parameters restricts the time on a car for kiss and ride (and ride and kiss)
-        params = copy.copy(person.otp_parameters)
-        params.update({'maxPreTransitTime': self.env.config.get('drt.maxPreTransitTime')})
+        params = self._get_drt_transit_params(person)
         drt_trips = []
 
-        if self.is_in_trip(person):
-            mode = OtpMode.RIDE_KISS
-        elif self.is_out_trip(person):
-            mode = OtpMode.KISS_RIDE
-        else:
-            raise Exception("Cannot determine if DRT+TRANSIT trip is going in or out service zone \n"
-                            "Check person's Origin-Destination \n"
-                            "{}".format(person))
+        mode = self._get_drt_transit_mode(person)
 
         # when generating kiss and ride trips, transfer stops may be outside the service zone
         # if this happens, maxPreTransitTime will be reduced.
@@ -261,13 +622,20 @@ class ServiceProvider(Component):
         status_log = {}
         while (not drt_trip_found) and pre_transit_time_reduction_cycles < 3:
             pre_transit_time_reduction_cycles += 1
+            if not (pre_transit_time_reduction_cycles == 1 and transit_prefetch is not None) \
+                    and not self._zone_stop_reachable(person, params):
+                # OTP would only find transfers outside the zone, so this and further cycles are not needed
+                self._kiss_ride_requests_prescreened += 1
+                if status_log != {}:
+                    break
+                else:
+                    self._drt_no_suitable_pt_stop += 1
+                    return [], DrtStatus.no_stop
             try:
-                pt_alternatives = self.router.otp_request(person.curr_activity.coord,
-                                                          person.next_activity.coord,
-                                                          person.next_activity.start_time,
-                                                          mode,
-                                                          params
-                                                          )
+                if pre_transit_time_reduction_cycles == 1 and transit_prefetch is not None:
+                    pt_alternatives = transit_prefetch.result()
+                else:
+                    pt_alternatives = self._kiss_ride_request(person, mode, params)
             except OTPNoPath:
                 if status_log != {}:
                     break
@@ -277,6 +645,7 @@ class ServiceProvider(Component):
 
             # TODO: currently taking a first trip that fits person's time window
             # TODO: check all feasible trips and form alternatives for each
+            candidates = []
             status_log = {
                 DrtStatus.no_stop: 0,
                 DrtStatus.undeliverable: 0,
@@ -376,16 +745,11 @@ class ServiceProvider(Component):
                     status_log[DrtStatus.too_late_request] += 1
                     continue
 
-                person.drt_leg = drt_leg.deepcopy()
-                try:
-                    self._drt_request_routine(person)
-                except DrtUnassigned:
-                    status_log[DrtStatus.unassigned] += 1
-                    continue
-                except DrtUndeliverable:
-                    status_log[DrtStatus.undeliverable] += 1
-                    continue
+                candidates.append((drt_trip, pt_walk_leg_index, drt_leg, person.drt_tw_left, person.drt_tw_right))
 
+            candidate = self._route_drt_candidates(person, candidates, status_log)
+            if candidate is not None:
+                drt_trip, pt_walk_leg_index = candidate[:2]
                 drt_trip.legs[pt_walk_leg_index] = person.drt_leg.deepcopy()
                 drt_trip.legs[pt_walk_leg_index].start_coord = person.drt_leg.start_coord
                 drt_trip.legs[pt_walk_leg_index].end_coord = person.drt_leg.start_coord
@@ -473,6 +837,80 @@ class ServiceProvider(Component):
             raise PTStopServiceOutsideZone('Person {} has outgoing trip, but bus stop is not in the zone'
                                            .format(person.id, drt_trip.legs[1].from_stop))
 
+    @staticmethod
+    def _set_drt_candidate(person: Person, candidate):
+        """Sets DRT leg and time window of a DRT_TRANSIT candidate to a person"""
+        person.drt_leg = candidate[2].deepcopy()
+        person.drt_tw_left, person.drt_tw_right = candidate[3:]
+
+    def _route_drt_candidates(self, person: Person, candidates, status_log):
+        """Routes DRT legs of DRT_TRANSIT candidates (trip, index of the DRT leg, DRT leg, time window left, right)
+        in their order and returns the first candidate that can be served or None.
+        Failures are counted in status_log.
+        NOTE: person.drt_leg and time window are left from the returned candidate
+
+        With service.parallel_solvers above one, that many candidates are solved at once against the same state
+        of the fleet. Solutions of candidates after the first served one are dropped and these candidates are
+        not counted, so the result and the counters do not depend on the number of solvers.
+        """
+        solvers = self.router.parallel_solvers
+        for start in range(0, len(candidates), solvers):
+            round_candidates = candidates[start:start + solvers]
+            if len(round_candidates) == 1:
+                self._set_drt_candidate(person, round_candidates[0])
+                try:
+                    self._drt_request_routine(person)
+                    return round_candidates[0]
+                except DrtUnassigned:
+                    status_log[DrtStatus.unassigned] += 1
+                except DrtUndeliverable:
+                    status_log[DrtStatus.undeliverable] += 1
+                continue
+
+            # problems are prepared one after another, as they use the state of the person,
+            # and only the solver runs in parallel
+            reasons = []
+            problems = []
+            # vehicles left out and time-distance pairs (fetched, reused) of each candidate,
+            # they are counted in order, as with a single solver
+            filtered_out = []
+            tdm_pairs = []
+            for slot, candidate in enumerate(round_candidates):
+                self._set_drt_candidate(person, candidate)
+                fetched, reused = self.router.get_tdm_pair_counts()
+                vehicles, vehicle_coords_times, vehicle_return_coords, waiting_persons, service_persons, \
+                    candidate_filtered_out = self._get_fleet_state([person.drt_leg.start_coord])
+                reason = self._get_infeasibility(person, vehicles, vehicle_coords_times)
+                reasons.append(reason)
+                if reason is None:
+                    problems.append(self.router.prepare_drt_problem(vehicles, vehicle_coords_times,
+                                                                    vehicle_return_coords, waiting_persons + [person],
+                                                                    service_persons, slot))
+                filtered_out.append(candidate_filtered_out)
+                fetched_after, reused_after = self.router.get_tdm_pair_counts()
+                tdm_pairs.append((fetched_after - fetched, reused_after - reused))
+            solved_problems = iter(zip(problems, self.router.solve_drt_problems(problems)))
+
+            for i, (candidate, reason) in enumerate(zip(round_candidates, reasons)):
+                self._drt_vehicles_filtered_out += filtered_out[i]
+                self._set_drt_candidate(person, candidate)
+                try:
+                    if reason is not None:
+                        self._reject_early(person, reason)
+                    problem, result = next(solved_problems)
+                    self.router.apply_drt_result(person, problem, result)
+                except DrtUnassigned:
+                    status_log[DrtStatus.unassigned] += 1
+                    continue
+                except DrtUndeliverable:
+                    status_log[DrtStatus.undeliverable] += 1
+                    continue
+                # a single solver would not have prepared candidates after the served one
+                for fetched, reused in tdm_pairs[i + 1:]:
+                    self.router.discount_tdm_pairs(fetched, reused)
+                return candidate
+        return None
+
     def _drt_request_routine(self, person: Person):
         """Prepares coordinate lists for routing
         NOTE: peron.drt_leg will be updated
@@ -480,24 +918,103 @@ class ServiceProvider(Component):
         Return : drt leg from router.drt_request
         """
 
-        vehicle_coords_times = self._get_current_vehicle_positions()
-        vehicle_return_coords = [vehicle.return_coord for vehicle in self.vehicles]
-
-        # get positions of scheduled requests
-        # person.leg.start_coord and .end_coord have that, so get the persons
-        persons = self.get_scheduled_travelers()
-        service_persons = self.get_onboard_travelers()
-        waiting_persons = list(set(persons) - set(service_persons))
+        vehicles, vehicle_coords_times, vehicle_return_coords, waiting_persons, service_persons, filtered_out = \
+            self._get_fleet_state([person.drt_leg.start_coord])
+        self._drt_vehicles_filtered_out += filtered_out
+        self._check_feasibility(person, vehicles, vehicle_coords_times)
         shipment_persons = waiting_persons
         shipment_persons += [person]
 
         # remove persons that are in the process of boarding or leaving a vehicle
 
-        self.router.drt_request(person, vehicle_coords_times, vehicle_return_coords,
+        self.router.drt_request(person, vehicles, vehicle_coords_times, vehicle_return_coords,
                                 shipment_persons, service_persons)
 
+    def _check_feasibility(self, person: Person, vehicles, vehicle_coords_times):
+        """Rejects a request that clearly cannot be served, without calling the solver.
+
+        Only necessary conditions are checked: the person fits into an empty vehicle, some vehicle can reach
+        the pickup before the end of the time window, and a direct ride from the pickup ends within it.
+        Driving times are lower bounds, see router.get_travel_time_bound
+
+        Raises DrtUnassigned
+        """
+        reason = self._get_infeasibility(person, vehicles, vehicle_coords_times)
+        if reason is not None:
+            self._reject_early(person, reason)
+
+    def _get_infeasibility(self, person: Person, vehicles, vehicle_coords_times):
+        """Returns the reason why a request clearly cannot be served or None, see _check_feasibility"""
+        if not self.env.config.get('drt.fast_rejection'):
+            return None
+
+        if not any(all(demand <= vehicle.vehicle_type.capacity_dimensions.get(dimension, 0)
+                       for dimension, demand in person.dimensions.items())
+                   for vehicle in vehicles):
+            return 'does not fit into any vehicle'
+
+        pickup_coord = person.drt_leg.start_coord
+        earliest_pickup = min([coord_time[1] + self.router.get_travel_time_bound(coord_time[0], pickup_coord)
+                               for coord_time in vehicle_coords_times] or [float('inf')])
+        if earliest_pickup > person.get_tw_right():
+            return 'no vehicle can reach the pickup before {}'.format(person.get_tw_right())
+
+        if pickup_coord == person.curr_activity.coord and person.drt_leg.end_coord == person.next_activity.coord:
+            ride_time = person.direct_trip.duration
+        else:
+            ride_time = self.router.get_travel_time_bound(pickup_coord, person.drt_leg.end_coord)
+        earliest_drop_off = max(earliest_pickup, person.get_tw_left()) + person.boarding_time + ride_time
+        if earliest_drop_off > person.get_tw_right():
+            return 'drop-off cannot be reached before {}'.format(person.get_tw_right())
+        return None
+
+    def _reject_early(self, person, reason):
+        self._drt_rejected_early += 1
+        raise DrtUnassigned('Person {} cannot be delivered by DRT, {}'.format(person.id, reason))
+
+    def _get_fleet_state(self, pickup_coords):
+        """Returns vehicles to route, their current positions and return coordinates,
+        waiting and onboard travelers of these vehicles and the number of vehicles left out of the problem"""
+        vehicles, vehicle_coords_times = self._get_candidate_vehicles(pickup_coords)
+        vehicle_return_coords = [vehicle.return_coord for vehicle in vehicles]
+
+        # get positions of scheduled requests
+        # person.leg.start_coord and .end_coord have that, so get the persons
+        service_persons = self.get_onboard_travelers(vehicles)
+        waiting_persons = self.get_waiting_travelers(vehicles)
+        return vehicles, vehicle_coords_times, vehicle_return_coords, waiting_persons, service_persons, \
+            len(self.vehicles) - len(vehicles)
+
+    def _get_candidate_vehicles(self, pickup_coords):
+        """Selects drt.candidate_vehicles vehicles that can be the earliest at any of pickup_coords,
+        according to a lower bound of driving time from the end of their current steps.
+        Routes of other vehicles are left untouched by the solver.
+
+        Returns vehicles and their current (coordinate, time) pairs. All vehicles are returned
+        if drt.candidate_vehicles is not set.
+        """
+        vehicle_coords_times = self._get_current_vehicle_positions()
+        candidates_number = self.env.config.get('drt.candidate_vehicles')
+        if not candidates_number or candidates_number >= len(self.vehicles):
+            return list(self.vehicles), vehicle_coords_times
+
+        earliest_arrivals = [coord_time[1] + min(self.router.get_travel_time_bound(coord_time[0], coord)
+                                                 for coord in pickup_coords)
+                             for coord_time in vehicle_coords_times]
+        candidates = sorted(sorted(range(len(self.vehicles)), key=lambda i: earliest_arrivals[i])[:candidates_number])
+        return [self.vehicles[i] for i in candidates], [vehicle_coords_times[i] for i in candidates]
+
     def standalone_osrm_request(self, person):
-        return self.router.osrm_route_request(person.curr_activity.coord, person.next_activity.coord)
+        """Returns a direct car trip of a person.
+        If the trip has been precomputed by population, its route is requested only when legs are accessed.
+        """
+        origin = person.curr_activity.coord
+        destination = person.next_activity.coord
+        estimate = self.population.get_direct_trip_estimate(origin, destination)
+        if estimate is None:
+            return self.router.osrm_route_request(origin, destination)
+        return DirectTrip(duration=estimate[0], distance=estimate[1],
+                          route_loader=lambda: self.router.osrm_route_request(origin, destination))
 
     def standalone_otp_request(self, person, mode, otp_attributes):
         attributes = copy.copy(person.otp_parameters)
@@ -516,12 +1033,14 @@ class ServiceProvider(Component):
         return coords_times
 
     def start_trip(self, person: Person):
-        if person.planned_trip.main_mode == OtpMode.DRT:
-            self._start_drt_trip(person)
-        elif person.planned_trip.main_mode == OtpMode.DRT_TRANSIT:
-            self._start_drt_trip(person)
+        if person.planned_trip.main_mode in [OtpMode.DRT, OtpMode.DRT_TRANSIT]:
+            # routes of a batch are committed when everybody in the batch has chosen
+            if person.id not in self._batch_of_person:
+                self._start_drt_trip(person)
+            self._person_decided(person, accepted=True)
         else:
             self._start_traditional_trip(person)
+            self._person_decided(person, accepted=False)
 
     def get_route_details(self, vehicle):
         if vehicle.get_route_len() == 0:
@@ -680,10 +1199,14 @@ class ServiceProvider(Component):
         jsprit_route = jsprit_solution.modified_route  # type: JspritRoute
 
         vehicle = self.get_vehicle_by_id(jsprit_route.vehicle_id)  # type: Vehicle
+        self._reroute_vehicle(vehicle, jsprit_route, [person])
 
+    def _reroute_vehicle(self, vehicle, jsprit_route: JspritRoute, persons):
+        """Replaces the route of a vehicle, persons are the new travelers of the route"""
         new_route = self._jsprit_to_drt(vehicle=vehicle, jsprit_route=jsprit_route)
         vehicle.update_partially_executed_trips()
-        person.update_planned_drt_trip(new_route)
+        for person in persons:
+            person.update_planned_drt_trip(new_route)
         vehicle.set_route(new_route)
 
         # If several request come at the same time, the same event will be triggered several times
@@ -739,50 +1262,73 @@ class ServiceProvider(Component):
         for leg in person.planned_trip.legs:
             self.env.results['{}_legs'.format(leg.mode)] += 1
 
-    def get_scheduled_travelers(self):
-        """Returns a list of persons who are scheduled for DRT transportation.
+    def get_scheduled_travelers(self, vehicles=None):
+        """Returns a list of persons who are scheduled for DRT transportation by vehicles, all vehicles by default.
         This list includes onboard persons as well.
 
         NOTE: persons currently leaving a vehicle are excluded from this list. So that jsprit would not serve them twice.
         """
-        persons = []
-        for vehicle in self.vehicles:
-            for i, act in enumerate(vehicle.get_route_without_return()):  # type: DrtAct
-                if i == 0 and act.type in [DrtAct.DROP_OFF, DrtAct.DELIVERY]:
-                    continue
-                else:
-                    persons.append(act.person)
-        return [a for a in set(persons) if a is not None]
+        persons = set()
+        for vehicle in vehicles if vehicles is not None else self.vehicles:
+            persons |= (self._waiting_persons[vehicle.id] | self._onboard_persons[vehicle.id]
+                        | self._boarding_persons[vehicle.id]) - self._alighting_persons[vehicle.id]
+        return sorted(persons, key=lambda person: person.id)
 
-    def get_onboard_travelers(self):
-        """Returns a list of persons that are currently on a vehicle.
+    def get_onboard_travelers(self, vehicles=None):
+        """Returns a list of persons that are currently on vehicles, on any vehicle by default.
 
         NOTE: persons currently leaving a vehicle are excluded from this list.
         So that jsprit would not drop them off twice.
 
         NOTE: persons boarding a vehicle are also added to this list, so that jsprit would treat them as DELIVERY
         """
-        persons = []
-        for vehicle in self.vehicles:
-            if vehicle.route_not_empty():
-                if vehicle.get_act(0).type in [DrtAct.DROP_OFF, DrtAct.DELIVERY]:
-                    persons += [person for person in vehicle.passengers if person != vehicle.get_act(0).person]
-                else:
-                    persons += vehicle.passengers
-
-                if vehicle.get_act(0).type == DrtAct.PICK_UP:
-                    persons += [vehicle.get_act(0).person]
-
-        return persons
+        persons = set()
+        for vehicle in vehicles if vehicles is not None else self.vehicles:
+            persons |= (self._onboard_persons[vehicle.id] | self._boarding_persons[vehicle.id]) \
+                - self._alighting_persons[vehicle.id]
+        return sorted(persons, key=lambda person: person.id)
+
+    def get_waiting_travelers(self, vehicles=None):
+        """Returns a list of persons who are scheduled, but have not boarded vehicles yet"""
+        persons = set()
+        for vehicle in vehicles if vehicles is not None else self.vehicles:
+            persons |= self._waiting_persons[vehicle.id]
+        return sorted(persons, key=lambda person: person.id)
+
+    def update_route_index(self, vehicle):
+        """Rebuilds sets of travelers of a vehicle after its route has been replaced"""
+        self._waiting_persons[vehicle.id] = set(act.person for act in vehicle.get_route_without_return()
+                                                if act.person is not None and act.person not in vehicle.passengers)
+        self.update_current_act_index(vehicle)
+
+    def update_current_act_index(self, vehicle):
+        """Updates travelers boarding and alighting at the current act of a vehicle"""
+        self._boarding_persons[vehicle.id] = set()
+        self._alighting_persons[vehicle.id] = set()
+        if vehicle.route_not_empty():
+            act = vehicle.get_act(0)  # type: DrtAct
+            if act.type == DrtAct.PICK_UP:
+                self._boarding_persons[vehicle.id].add(act.person)
+            elif act.type in [DrtAct.DROP_OFF, DrtAct.DELIVERY]:
+                self._alighting_persons[vehicle.id].add(act.person)
+
+    def add_onboard_travelers(self, vehicle, persons):
+        self._waiting_persons[vehicle.id].difference_update(persons)
+        self._onboard_persons[vehicle.id].update(persons)
+
+    def remove_onboard_travelers(self, vehicle, persons):
+        self._onboard_persons[vehicle.id].difference_update(persons)
 
     def log_unassigned_trip(self, person):
         self.unassigned_trips.append(UnassignedTrip(person))
 
     def log_unplannable(self, person):
         self._unplannable_persons += 1
+        self._person_decided(person, accepted=False)
 
     def log_unchoosable(self, person):
         self._unchoosable_persons += 1
+        self._person_decided(person, accepted=False)
 
     def log_unactivatable(self, person):
         self._unactivatable_persons += 1
@@ -790,6 +1336,10 @@ class ServiceProvider(Component):
     def log_unreactivatable(self, person):
         self.log_unactivatable(person)
 
+    def post_sim_hook(self):
+        self._otp_executor.shutdown()
+        self.router.close()
+
     def get_result(self, result):
         super(ServiceProvider, self).get_result(result)
         # result['no_unassigned_drt_trips'] = len(self.unassigned_trips)
@@ -803,7 +1353,18 @@ class ServiceProvider(Component):
         result['drt_one_leg'] = self._drt_one_leg
         result['too_late_request'] = self._drt_too_late_request
         result['too_long_pt_trip'] = self._drt_too_long_pt_trip
+        result['drt_batches'] = self._drt_batches
+        result['drt_batched_requests'] = self._drt_batched_requests
+        result['drt_vehicles_filtered_out'] = self._drt_vehicles_filtered_out
+        result['drt_rejected_before_solver'] = self._drt_rejected_early
+        result['drt_dominated_requests'] = self._drt_dominated_requests
+        # every miss of the memo is sent to OTP
+        result['kiss_ride_otp_requests'] = self._kiss_ride_cache.misses
+        result['kiss_ride_cache_hits'] = self._kiss_ride_cache.hits
+        result['kiss_ride_requests_prescreened'] = self._kiss_ride_requests_prescreened
 
         result['unplannable_persons'] = self._unplannable_persons
         result['unchoosable_persons'] = self._unchoosable_persons
         result['unactivatable_persons'] = self._unactivatable_persons
+
+        self.router.get_result(result)
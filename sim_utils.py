@@ -12,6 +12,8 @@ from datetime import datetime
 import logging
 import copy
 import json
+import math
+from itertools import accumulate, chain
 
 from const import OtpMode, LegMode
 
@@ -61,7 +63,12 @@ class Leg(object):
     distance : <int> meters
     duration : <int> seconds
     steps : <list> of utils.Step
+
+    Steps are kept in a tuple and are never modified, so copies of a leg share them.
+    To change steps of a leg assign a new sequence.
     """
+    __slots__ = ('mode', 'start_coord', 'end_coord', 'distance', 'duration', '_steps', 'from_stop', 'to_stop',
+                 'start_time', 'end_time')
 
     # TODO:assignment of mode as a string is confusing, remove it, or use constant
     def __init__(self, mode=None, start_coord=None, from_stop=None, end_coord=None, to_stop=None,
@@ -80,21 +87,40 @@ class Leg(object):
         self.start_time = start_time
         self.end_time = end_time
 
+    @property
+    def steps(self):
+        return self._steps
+
+    @steps.setter
+    def steps(self, steps):
+        self._steps = tuple(steps) if steps is not None else None
+
     def deepcopy(self):
-        if self.steps is None:
-            steps = []
-        else:
-            steps = [step.deepcopy() for step in self.steps if step is not None]
-        return Leg(mode=copy.copy(self.mode),
-                   start_coord=copy.copy(self.start_coord),
+        """Returns a copy of a leg that can be changed independently.
+        Steps and coordinates are immutable and are shared with the copy.
+        """
+        return Leg(mode=self.mode,
+                   start_coord=self.start_coord,
                    from_stop=copy.copy(self.from_stop),
-                   end_coord=copy.copy(self.end_coord),
+                   end_coord=self.end_coord,
                    to_stop=copy.copy(self.to_stop),
-                   start_time=copy.copy(self.start_time),
-                   end_time=copy.copy(self.end_time),
-                   distance=copy.copy(self.distance),
-                   duration=copy.copy(self.duration),
-                   steps=steps)
+                   start_time=self.start_time,
+                   end_time=self.end_time,
+                   distance=self.distance,
+                   duration=self.duration,
+                   steps=self._steps if self._steps is not None else ())
+
+    def dumps(self):
+        return {'mode': self.mode,
+                'start_coord': self.start_coord,
+                'end_coord': self.end_coord,
+                'distance': self.distance,
+                'duration': self.duration,
+                'steps': self._steps,
+                'from_stop': self.from_stop,
+                'to_stop': self.to_stop,
+                'start_time': self.start_time,
+                'end_time': self.end_time}
 
 
 class Step(object):
@@ -103,6 +129,8 @@ class Step(object):
     distance    <int>|
     duration    <int>|
     """
+    __slots__ = ('start_coord', 'end_coord', 'distance', 'duration')
+
     def __init__(self, start_coord, end_coord, distance, duration):
         self.start_coord = start_coord
         self.end_coord = end_coord
@@ -121,7 +149,7 @@ class Step(object):
                     )
 
     def dumps(self):
-        return self.__dict__
+        return {attr: getattr(self, attr) for attr in self.__slots__}
 
     def __str__(self):
         return 'Step distance {:.1f}, duration {:.1f}'.format(self.distance, self.duration)
@@ -199,6 +227,52 @@ class Trip(object):
     def __repr__(self):
         return str(self)
 
+
+class DirectTrip(Trip):
+    """A car trip with duration and distance known in advance, e.g. from OSRM table service.
+    Legs with full geometry are requested only when they are accessed.
+
+    Parameters
+    ----------
+    duration : <float> seconds
+    distance : <float> meters
+    route_loader : function without arguments that returns a routed Trip
+    """
+
+    def __init__(self, duration, distance, route_loader):
+        super(DirectTrip, self).__init__()
+        self._legs = None
+        self.route_loader = route_loader
+        self.duration = duration
+        self.distance = distance
+        self.main_mode = OtpMode.CAR
+
+    @property
+    def legs(self):
+        if self._legs is None:
+            self._legs = self.route_loader().legs
+        return self._legs
+
+    @legs.setter
+    def legs(self, legs):
+        self._legs = legs
+
+    def is_routed(self):
+        return self._legs is not None
+
+    def dumps(self):
+        return {'legs': self._legs if self._legs is not None else [],
+                'duration': self.duration,
+                'distance': self.distance,
+                'main_mode': self.main_mode}
+
+    def deepcopy(self):
+        nt = DirectTrip(self.duration, self.distance, self.route_loader)
+        nt.main_mode = copy.copy(self.main_mode)
+        if self._legs is not None:
+            nt.legs = [leg.deepcopy() for leg in self._legs]
+        return nt
+
     # def find_main_mode(self):
     #     modes = [leg.mode for leg in self.legs]
         # if Mode.CAR in modes:
@@ -236,6 +310,8 @@ class ActType(object):
     RETURN = 5
     IDLE = 6
 
+    __slots__ = ('type',)
+
     def __init__(self, type_=None):
         self.type = type_
 
@@ -265,6 +341,7 @@ class ActType(object):
 
 
 class JspritAct(ActType):
+    __slots__ = ('person_id', 'end_time', 'arrival_time')
 
     def __init__(self, type_=None, person_id=None, end_time=None, arrival_time=None):
         super(JspritAct, self).__init__(type_=type_)
@@ -284,6 +361,8 @@ class JspritAct(ActType):
 
 
 class DrtAct(ActType):
+    __slots__ = ('person', 'duration', 'end_coord', 'distance', 'start_time', 'start_coord', 'end_time',
+                 '_steps', '_step_end_times')
 
     def __init__(self, start_coord=None, type_=None, person=None, duration=None, end_coord=None, distance=None,
                  start_time=None, end_time=None, steps=None):
@@ -302,6 +381,28 @@ class DrtAct(ActType):
         self.end_time = end_time
         self.steps = steps
 
+    @property
+    def steps(self):
+        return self._steps
+
+    @steps.setter
+    def steps(self, steps):
+        # steps are shared between copies of an act and legs of trips, so they are kept in a tuple
+        self._steps = tuple(steps) if steps is not None else None
+        # (start_time, end times of steps), see get_step_end_times
+        self._step_end_times = None
+
+    def get_step_end_times(self):
+        """Returns a list with the end time of each step.
+
+        The list is calculated once for the current steps and start_time, so that a position of a vehicle
+        can be found with a binary search.
+        """
+        if self._step_end_times is None or self._step_end_times[0] != self.start_time:
+            end_times = list(accumulate(chain([self.start_time], (step.duration for step in self._steps))))[1:]
+            self._step_end_times = (self.start_time, end_times)
+        return self._step_end_times[1]
+
     def __str__(self):
         return '{}, type {}, duration {}, distance {}, start_time {}, end_time {}'\
             .format(self.person, self.type, self.duration, self.distance, self.start_time, self.end_time)
@@ -316,12 +417,12 @@ class DrtAct(ActType):
         return DrtAct(type_=copy.deepcopy(self.type),
                       person=self.person,
                       duration=copy.deepcopy(self.duration),
-                      end_coord=copy.deepcopy(self.end_coord),
+                      end_coord=self.end_coord,
                       distance=copy.deepcopy(self.distance),
                       start_time=copy.deepcopy(self.start_time),
-                      start_coord=copy.deepcopy(self.start_coord),
+                      start_coord=self.start_coord,
                       end_time=copy.deepcopy(self.end_time),
-                      steps=copy.deepcopy(self.steps)
+                      steps=self.steps
                       )
 
     def remove_disembark_step(self):
@@ -331,7 +432,7 @@ class DrtAct(ActType):
         """
         if self.steps[-1].distance == 0 and self.steps[-1].duration != 0:
             self.duration -= self.steps[-1].duration
-            self.steps.pop(-1)
+            self.steps = self.steps[:-1]
 
     def remove_embark_step(self):
         """Removes boarding or getting of step from an act
@@ -340,24 +441,24 @@ class DrtAct(ActType):
         """
         if self.steps[0].distance == 0 and self.steps[0].duration != 0:
             self.duration -= self.steps[0].duration
-            self.steps.pop(0)
+            self.steps = self.steps[1:]
 
     def add_disembark_step(self, embark_time):
         """Adds a step for boarding or getting off a vehicle. Step has zero distance.
          Opposite to remove_embark_step
         """
         self.duration += embark_time
-        self.steps.append(Step(self.steps[-1].start_coord, self.steps[-1].end_coord, 0, embark_time))
+        self.steps = self.steps + (Step(self.steps[-1].start_coord, self.steps[-1].end_coord, 0, embark_time),)
 
     def add_embark_step(self, embark_time, embark_coord):
         """Adds a step for boarding or getting off a vehicle. Step has zero distance.
          Opposite to remove_embark_step
         """
         self.duration += embark_time
-        self.steps = [Step(embark_coord, embark_coord, 0, embark_time)] + self.steps
+        self.steps = (Step(embark_coord, embark_coord, 0, embark_time),) + self.steps
 
     def add_wait_step(self, duration):
-        self.steps.append(Step(self.steps[-1].start_coord, self.steps[-1].start_coord, 0, duration))
+        self.steps = self.steps + (Step(self.steps[-1].start_coord, self.steps[-1].start_coord, 0, duration),)
 
 
 class JspritRoute(object):
@@ -379,6 +480,8 @@ class Coord(object):
     lon : <float> longitude
     latlon : <list> list with both lat and long. Latitude first!
     """
+    __slots__ = ('lat', 'lon')
+
     def __init__(self, lat=None, lon=None, latlon=None):
         if latlon is not None:
             if len(latlon) != 2:
@@ -394,6 +497,9 @@ class Coord(object):
     def to_json(self):
         return json.dumps(self, default=lambda o: self._try(o), sort_keys=True, indent=4, separators=(',', ':'))
 
+    def dumps(self):
+        return {'lat': self.lat, 'lon': self.lon}
+
     @staticmethod
     def _try(o):
         try:
@@ -424,6 +530,16 @@ class JspritSolution(object):
         self.modified_route = None
 
 
+EARTH_RADIUS = 6371000
+
+
+def haversine_distance(coord1, coord2):
+    """Great-circle distance between two coordinates in meters"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (coord1.lat, coord1.lon, coord2.lat, coord2.lon))
+    a = math.sin((lat2 - lat1) / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
 def trunc_microseconds(time_str):
     if '.' in time_str:
         time, _ = time_str.split('.')
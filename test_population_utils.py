@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Checks that population files are decoded the same way whatever the chunk boundaries are
+
+Usage: python -m pytest test_population_utils.py
+"""
+
+import io
+import json
+import unittest
+
+from population_utils import JsonListStream, read_json_lists
+
+
+class JsonListStreamTest(unittest.TestCase):
+    DOCUMENT = '{"a": [1.5, 2.25e3, -7, 10, 0.125E-2], "b": [{"c": [1, "x, ]"]}, true, null], ' \
+               '"d": [3.0e1, 12345678901234567890]}'
+
+    def read(self, keys, chunk_size):
+        stream = JsonListStream(io.StringIO(self.DOCUMENT), keys, chunk_size=chunk_size)
+        return {key: list(elements) for key, elements in stream.lists()}
+
+    def test_chunk_sizes(self):
+        expected = json.loads(self.DOCUMENT)
+        for chunk_size in range(1, len(self.DOCUMENT) + 2):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.read(['a', 'b', 'd'], chunk_size), expected)
+                self.assertEqual(self.read(['d'], chunk_size), {'d': expected['d']})
+
+    def test_read_json_lists_order(self):
+        elements = list(read_json_lists(io.StringIO(self.DOCUMENT), ['d', 'a']))
+        expected = json.loads(self.DOCUMENT)
+        self.assertEqual(elements, expected['d'] + expected['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
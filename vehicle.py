@@ -1,5 +1,6 @@
 
 import copy
+from bisect import bisect_left
 from typing import List
 import logging
 import csv
@@ -12,6 +13,7 @@ from population import Person
 
 from const import CapacityDimensions as CD
 from const import VehicleCost as VC
+from const import EventPriority
 from log_utils import Event, TravellerEventType, VehicleEventType
 import service
 
@@ -79,6 +81,7 @@ class Vehicle(Component):
 
     def set_route(self, route):
         self._route = route
+        self.service.update_route_index(self)
 
     def get_route_without_return(self):
         return self._route[:-1]
@@ -101,7 +104,9 @@ class Vehicle(Component):
         return self._route[i]
 
     def pop_act(self):
-        return self._route.pop(0)
+        act = self._route.pop(0)
+        self.service.update_current_act_index(self)
+        return act
 
     def get_route_len(self):
         return len(self._route)
@@ -214,7 +219,9 @@ class Vehicle(Component):
                 log.error('{}: Negative delay of {} is encountered. Resetting it to zero,'
                           .format(self.env.now, timeout))
                 timeout = 0
-            act_executed = self.env.timeout(timeout)  # type: Timeout
+            # if a new request comes at exactly the same time as a vehicle reaches a destination,
+            # the request is processed first
+            act_executed = self.env.timeout(timeout, priority=EventPriority.ACT_COMPLETION)  # type: Timeout
             yield self.rerouted | act_executed
 
             if self.rerouted.triggered:
@@ -223,11 +230,6 @@ class Vehicle(Component):
                 # all the rerouting happens in the service provider
 
             elif act_executed.triggered:
-                # if a new request came at exactly the same time as a vehicle reached a destination,
-                # request should be processed first
-                # TODO: try to do it with priority resource in a service
-                if self.env.peek() == self.env.now:
-                    yield self.env.timeout(0.05)
                 act = self.pop_act()  # type: DrtAct
                 # TODO: add vehicle kilometers when first act is rerouted
                 if act.distance is None:
@@ -286,6 +288,7 @@ class Vehicle(Component):
     def _drop_off_travelers(self, persons):
         """Remove person from the list of current passengers and calculate statistics"""
         self.passengers = [p for p in self.passengers if p not in persons]
+        self.service.remove_onboard_travelers(self, persons)
 
         for person in persons:
             person.finish_actual_drt_trip(self.env.now)
@@ -323,6 +326,7 @@ class Vehicle(Component):
         """Append persons to the list of current passengers
         and reduce capacity dimensions according to traveler's attributes"""
         self.passengers += persons
+        self.service.add_onboard_travelers(self, persons)
         for person in persons:
             person.start_actual_drt_trip(self.env.now, self.coord)
             for dimension in person.dimensions.items():
@@ -409,20 +413,17 @@ class Vehicle(Component):
         if current_time == self.env.now:
             return act.start_coord, self.env.now
 
-        for cstep, nstep in zip(act.steps, act.steps[1:]):
-            current_time += cstep.duration
-            if current_time >= self.env.now:
-                return nstep.start_coord, current_time
-            else:
-                pass
-
-        current_time += act.steps[-1].duration
-        if current_time >= self.env.now:
-            return act.end_coord, current_time
+        # index of the first step that ends at or after now
+        end_times = act.get_step_end_times()
+        i = bisect_left(end_times, self.env.now)
+        if i < len(act.steps) - 1:
+            return act.steps[i + 1].start_coord, end_times[i]
+        elif i == len(act.steps) - 1:
+            return act.end_coord, end_times[i]
         else:
             log.error('{}: There is not enough of steps at_time to fill the act, returning end of a current act.\n{}'
                       .format(self.env.now, act.flush()))
-            return act.end_coord, current_time
+            return act.end_coord, end_times[-1]
             # raise Exception('There is not enough of steps at_time to fill the act')
 
     def get_current_step(self) -> Step:
@@ -434,8 +435,8 @@ class Vehicle(Component):
         current_time = act.start_time
         if len(act.steps) == 0:
             log.error('Vehicle {} has an empty act. Trying to fill act with one step'.format(self.id))
-            act.steps.append(Step(start_coord=act.start_coord, end_coord=act.end_coord,
-                                  distance=act.distance, duration=act.duration))
+            act.steps = [Step(start_coord=act.start_coord, end_coord=act.end_coord,
+                              distance=act.distance, duration=act.duration)]
 
             return act.steps[-1]
             # raise Exception('Vehicle {} has an empty act\n{}'.format(self.id, self.flush()))
@@ -443,14 +444,12 @@ class Vehicle(Component):
         if current_time == self.env.now:
             return None
 
-        for step in act.steps:
-            current_time += step.duration
-            if current_time == self.env.now:
+        end_times = act.get_step_end_times()
+        i = bisect_left(end_times, self.env.now)
+        if i < len(act.steps):
+            if end_times[i] == self.env.now:
                 return None
-            elif current_time >= self.env.now:
-                return step
-            else:
-                pass
+            return act.steps[i]
 
         log.error('{}: There is not enough of steps at_time to fill the act, returning the last step.\n{}'
                   .format(self.env.now, act.flush()))
@@ -459,7 +458,6 @@ class Vehicle(Component):
 
     def get_passed_steps(self):
         """Returns steps which vehicle has executed by now. DOES NOT include current step"""
-        steps = []
         act = self.get_act(0)
         current_time = act.start_time
 
@@ -471,21 +469,13 @@ class Vehicle(Component):
                         duration=0, distance=0)
             # raise Exception('{}: Vehicle {} has an empty act\n{}'.format(self.env.now, self.id, self.flush()))
 
-        for step in act.steps:
-            current_time += step.duration
-            if current_time >= self.env.now:
-                return steps
-            else:
-                steps.append(step)
-
-            # for c_step, n_step in zip(self.steps, self.steps[1:] + [self.steps[-1]]):
-            #     current_time += c_step.duration
-            #     steps.append(c_step)
-            #     if current_time >= by_time:
-            #         return steps
+        i = bisect_left(act.get_step_end_times(), self.env.now)
+        if i < len(act.steps):
+            return act.steps[:i]
 
         log.error('{}: Vehicle {} has an act that do not sums up to a current time.'
                   'Filling missing time with a single step of zero length'.format(self.env.now, self.id))
+        steps = list(act.steps)
         steps.append(Step(start_coord=steps[-1].end_coord, end_coord=act.end_coord,
                           duration=0, distance=0))
         return steps